@@ -2,35 +2,53 @@ import json
 from flask import Flask, request, jsonify, render_template, session
 from flask_cors import CORS
 from flask_socketio import SocketIO
-import groq
 import re
 import threading
 from datetime import datetime, timedelta
 import os
+import tempfile
 from twilio.rest import Client as TwilioClient
 from dotenv import load_dotenv
 import base64
-from PyPDF2 import PdfReader
-import docx
-import faiss
-import numpy as np
-from sentence_transformers import SentenceTransformer
+from retrieval_client import RetrievalClient
+from intent_classifier import IntentClassifier
+from intent_rules import classify_intent, extract_time
+from llm_gateway import LLMUnavailable, make_client
+from model_routing import route
 
 load_dotenv()
 # Initialize Flask app with SocketIO
 app = Flask(__name__)
 CORS(app)
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode="threading")
 
 groq_api_key = os.getenv("GROQ_API_KEY")
-client = groq.Client(api_key=groq_api_key) 
+client = make_client(groq_api_key)  # queued, retried and circuit-broken per model
 
-embedding_model = SentenceTransformer("all-MiniLM-L6-v2")
+# Document embedding and retrieval: the shared service when EMBED_SERVICE_URL is set,
+# otherwise an in-process encoder and persistent index (see retrieval_client.py)
+retrieval = RetrievalClient("app")
 
-# Global index and mapping
-index = faiss.IndexFlatL2(384)  # For all-MiniLM-L6-v2
-id_to_text = {}
-next_id = 0 
+# Intents are classified by rules, then by the encoder above, then by the LLM
+intent_classifier = IntentClassifier(retrieval.embed, embed_query=retrieval.embed_query)
+
+# Loaded in the background once per serving process: from __main__, or on the first
+# request when a server such as gunicorn imports the app instead
+warm_up_lock = threading.Lock()
+warm_up_started = False
+
+def start_warm_up():
+    global warm_up_started
+    with warm_up_lock:
+        if warm_up_started:
+            return
+        warm_up_started = True
+    retrieval.start_warm_up()
+    threading.Thread(target=intent_classifier.fit, daemon=True).start()
+
+@app.before_request
+def warm_up_on_first_request():
+    start_warm_up()
 
 def detect_intent_llm(text):
     prompt = [
@@ -55,7 +73,7 @@ def detect_intent_llm(text):
     ]
 
     response = client.chat.completions.create(
-        model="llama3-70b-8192",
+        **route("classify"),
         messages=prompt
     )
 
@@ -89,7 +107,7 @@ def extract_time_llm(text):
     ]
 
     response = client.chat.completions.create(
-        model="llama3-70b-8192",
+        **route("extract_time"),
         messages=prompt
     )
 
@@ -136,13 +154,13 @@ def start_timer(seconds):
     threading.Timer(seconds, lambda: socketio.emit("timer_finished", {"message": "✅ Timer finished! Take a short break! ☕"})).start()
 
 # Generate chatbot response using Groq
-def generate_response(query):
+def generate_response(query, intent="general_query"):
     search_prompt = [
         {"role": "system", "content": "You are an Mathematical AI Study Assistant.you have to provide the accurate mathmatical solutions for the students. Help students with study schedules, reminders, and motivation. Provide minimal and engaging responses. Keep answers concise..don't provide many responses make it simple and easy to understand pointwise explain it."},
         {"role": "user", "content": f"User Query: {query}"}
     ]
 
-    response = client.chat.completions.create(model="llama3-70b-8192", messages=search_prompt)
+    response = client.chat.completions.create(**route(intent), messages=search_prompt)
     raw_response = response.choices[0].message.content
     return clean_response(raw_response)
 
@@ -153,7 +171,7 @@ def generate_greeting_response(user_input):
         {"role": "user", "content": f"User Query: {user_input}"}
     ]
 
-    response = client.chat.completions.create(model="llama3-70b-8192", messages=greet_prompt)
+    response = client.chat.completions.create(**route("greeting"), messages=greet_prompt)
     raw_response = response.choices[0].message.content
     return clean_response(raw_response)
 
@@ -162,7 +180,7 @@ def transcribe_audio_to_text(audio_path):
     with open(audio_path, "rb") as file:
         transcription = client.audio.transcriptions.create(
             file=(audio_path, file.read()),
-            model="whisper-large-v3-turbo",
+            **route("transcribe"),
             response_format="verbose_json",
             language="en"
         )
@@ -190,7 +208,7 @@ def handle_image_query(image_file, query=None):
 
     # Send to llama-3.2-11b-vision-preview via Groq client
     response = client.chat.completions.create(
-        model="llama-3.2-11b-vision-preview",
+        **route("image"),
         messages=[
             {
                 "role": "user",
@@ -208,30 +226,14 @@ def is_image(file):
     return file.mimetype.startswith('image/')
 
 
-def extract_text(file):
-    ext = file.filename.lower()
-    if ext.endswith(".pdf"):
-        reader = PdfReader(file)
-        return "\n".join(page.extract_text() for page in reader.pages if page.extract_text())
-    elif ext.endswith(".docx"):
-        doc = docx.Document(file)
-        return "\n".join([para.text for para in doc.paragraphs])
-    elif ext.endswith(".txt"):
-        return file.read().decode("utf-8")
-    else:
-        raise ValueError("Unsupported file type")
-    
-def store_file_and_index(file):
-    global next_id
-
-    text = extract_text(file)
-    chunks = [text[i:i+500] for i in range(0, len(text), 500)]
-
-    for chunk in chunks:
-        embedding = embedding_model.encode(chunk, normalize_embeddings=True).astype("float32")
-        index.add(np.array([embedding]))
-        id_to_text[next_id] = chunk
-        next_id += 1
+def store_file_and_index(file, namespace=""):
+    # Saved to disk so the shared embedding service can read it too
+    with tempfile.NamedTemporaryFile(suffix=os.path.basename(file.filename), delete=False) as tmp:
+        file.save(tmp)
+    try:
+        return retrieval.index_file(tmp.name, file.filename, namespace)
+    finally:
+        os.remove(tmp.name)
 
 def generate_llama_response_with_context(query, context):
     final_prompt = f"""You are a Excellent mathematical Study Buddy assistant. Use the following context to answer the question.solve the mathematical equation with highest accuracy in the most easiest way and make it easy to understand for the students.
@@ -243,7 +245,7 @@ Question:
 {query}
 """
     chat_completion = client.chat.completions.create(
-        model="meta-llama/llama-4-maverick-17b-128e-instruct",  # Or llama-3.3-70b-versatile
+        **route("document_query"),
         messages=[
             {"role": "system", "content": "You are a knowledgeable Maths assistant. Your job is to provide clear and accurate responses based strictly on the provided context.solve the maths aptitude or any equation problem in the best and Easy way so that students can understand.Dont provide information any other than the context strictly follow this rule "},
             {"role": "user", "content": final_prompt}
@@ -252,13 +254,6 @@ Question:
     return chat_completion.choices[0].message.content.strip()
 
 
-def retrieve_relevant_text(query, top_k=5):
-    query_embedding = embedding_model.encode(query, normalize_embeddings=True).reshape(1, -1).astype("float32")
-    distances, indices = index.search(query_embedding, top_k)
-
-    retrieved = [id_to_text.get(i, "") for i in indices[0] if i >= 0]
-    return "\n".join(retrieved) if retrieved else "No relevant context found."
-
 
 @app.route("/chat", methods=["POST"])
 def chat():
@@ -274,6 +269,8 @@ def chat():
             try:
                 response_text = handle_image_query(file, query)
                 return jsonify({"response": response_text})
+            except LLMUnavailable:
+                raise  # answered with a 503 by llm_unavailable
             except Exception as e:
                 print("Image handling error:", e)
                 return jsonify({"response": "❌ Failed to process the image."}), 500
@@ -282,11 +279,16 @@ def chat():
             try:
                 store_file_and_index(file)
                 if query:
-                    context = retrieve_relevant_text(query)
-                    response_text = generate_llama_response_with_context(query, context)
+                    chunks = retrieval.select_context(query)
+                    if chunks:
+                        response_text = generate_llama_response_with_context(query, "\n".join(chunks))
+                    else:
+                        response_text = generate_response(query)
                     return jsonify({"response": response_text})
                 else:
                     return jsonify({"response": "📁 File processed. Ask your question related to the content."})
+            except LLMUnavailable:
+                raise  # answered with a 503 by llm_unavailable
             except Exception as e:
                 print("Document handling error:", e)
                 return jsonify({"response": "❌ Failed to process the document."}), 500
@@ -316,7 +318,7 @@ def chat():
         })
 
     # 🤖 Intent Detection and Execution
-    sub_queries = detect_intent_llm(user_input)
+    sub_queries = classify_intent(user_input, detect_intent_llm, intent_classifier)  # LLM only when unsure
     print("Detected sub-queries:", sub_queries)
 
     responses = []
@@ -330,7 +332,7 @@ def chat():
             responses.append(generate_greeting_response(query))
 
         elif intent in ["study_schedule", "set_reminder"]:
-            time_data = extract_time_llm(query)
+            time_data = extract_time(item, extract_time_llm)
             print("Time LLM Output:", time_data)
 
             if time_data:
@@ -360,7 +362,7 @@ def chat():
                 responses.append("⌛ I can set up your study session, but I need a valid time. When should we start? 🕒")
 
         elif intent == "motivation":
-            responses.append(generate_response(query))
+            responses.append(generate_response(query, intent))
 
         else:  # general_query or fallback
             responses.append(generate_response(query))
@@ -373,10 +375,19 @@ def chat():
 
 
     
+@app.errorhandler(LLMUnavailable)
+def llm_unavailable(e):
+    """The LLM is rate limited or failing: answer quickly instead of with a 500."""
+    print(f"LLM unavailable: {e}")
+    return jsonify({"response": "⏳ The study buddy is busy right now. Please try again in a moment."}), 503
+
 @app.route("/")
 def home():
     return render_template("index.html")
 
 
 if __name__ == "__main__":
-    socketio.run(app, host="0.0.0.0", port=8000, debug=True)
+    # The debug reloader runs this file twice; only the serving child warms up
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_warm_up()
+    socketio.run(app, host="0.0.0.0", port=8000, debug=True, allow_unsafe_werkzeug=True)
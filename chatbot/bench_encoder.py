@@ -0,0 +1,88 @@
+import os
+import sys
+import time
+import argparse
+import subprocess
+import numpy as np
+from encoders import export_onnx, load_encoder
+from doc_index import EMBED_BATCH_SIZE, chunk_text
+
+# Compares the sentence encoder backends against PyTorch sentence-transformers: cold
+# load time in a fresh process, sentences/sec, and cosine similarity of every embedding
+# with the PyTorch one (the parity check; exits non-zero when a backend falls short).
+#
+#   python bench_encoder.py
+#   python bench_encoder.py --backends onnx-int8 --text notes.txt
+
+BACKENDS = ["torch", "onnx", "onnx-int8"]
+MIN_COSINE = {"onnx": 0.999, "onnx-int8": 0.98}
+
+WORDS = ("the derivative of a function measures how its output changes with its input; "
+         "photosynthesis converts light energy into chemical energy stored in glucose; "
+         "a prime number has exactly two divisors; the French revolution began in 1789; "
+         "Newton's second law relates force, mass and acceleration; solve x^2 - 5x + 6 = 0").split()
+
+
+def synthetic_sentences(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return [" ".join(rng.choice(WORDS, rng.integers(5, 80))) for _ in range(n)]
+
+
+def cold_load_seconds(backend):
+    # A fresh interpreter, so imports and weight loading are both counted
+    code = ("import time; started = time.perf_counter(); from encoders import load_encoder; "
+            f"load_encoder({backend!r}).encode('warm up'); print(time.perf_counter() - started)")
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def benchmark(backends, sentences, batch_size):
+    for backend in backends:
+        # One-time exports are not part of the cold load
+        if backend.startswith("onnx"):
+            export_onnx(quantize=backend == "onnx-int8")
+
+    print(f"{len(sentences)} sentences, batch size {batch_size}")
+    print(f"{'backend':<10} {'cold load s':>11} {'sentences/s':>12} {'min cos':>8} {'mean cos':>9}")
+    reference = None
+    failed = []
+    for backend in ["torch"] + [b for b in backends if b != "torch"]:
+        encoder = load_encoder(backend)
+        encoder.encode(sentences[:batch_size], batch_size=batch_size, normalize_embeddings=True)  # warm up
+        started = time.perf_counter()
+        embeddings = encoder.encode(sentences, batch_size=batch_size, normalize_embeddings=True,
+                                    convert_to_numpy=True, show_progress_bar=False)
+        rate = len(sentences) / (time.perf_counter() - started)
+        if reference is None:
+            reference = embeddings
+        cosine = np.sum(embeddings * reference, axis=1)
+        verdict = ""
+        if backend in MIN_COSINE:
+            verdict = "ok" if cosine.min() >= MIN_COSINE[backend] else f"FAIL (< {MIN_COSINE[backend]})"
+            if verdict != "ok":
+                failed.append(backend)
+        if backend in backends:
+            print(f"{backend:<10} {cold_load_seconds(backend):>11.2f} {rate:>12.1f} "
+                  f"{cosine.min():>8.4f} {cosine.mean():>9.4f}  {verdict}")
+    return not failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark and parity-check sentence encoder backends")
+    parser.add_argument("--backends", nargs="+", default=BACKENDS, choices=BACKENDS)
+    parser.add_argument("--text", help="text file to chunk and encode instead of synthetic sentences")
+    parser.add_argument("--sentences", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE)
+    args = parser.parse_args()
+
+    if args.text:
+        with open(args.text, encoding="utf-8") as f:
+            sentences = chunk_text(f.read())[:args.sentences]
+    else:
+        sentences = synthetic_sentences(args.sentences)
+    sys.exit(0 if benchmark(args.backends, sentences, args.batch_size) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import argparse
+import time
+import numpy as np
+import faiss
+from doc_index import build_ann_index, make_flat_index, rerank, RERANK_FACTOR
+
+# Compares the document index storage modes against the exact IndexFlatL2 baseline:
+# memory per million chunks, recall@5 with and without exact re-ranking, query latency.
+#
+#   python bench_index.py                       # synthetic clustered 384-d vectors
+#   python bench_index.py --vectors index_data/main/vectors.f32 --queries 500
+
+CONFIGS = [
+    ("flat", "none"),
+    ("flat", "sq8"),
+    ("ivf", "none"),
+    ("ivf", "sq8"),
+    ("ivf", "pq"),
+    ("hnsw", "none"),
+    ("hnsw", "sq8"),
+    ("hnsw", "pq"),
+]
+
+
+def synthetic_vectors(n, dim, seed=0):
+    # Unit vectors around a few thousand topics, closer to sentence embeddings than pure noise
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(1, n // 100), dim)).astype("float32")
+    vectors = centers[rng.integers(0, len(centers), n)] + 0.6 * rng.standard_normal((n, dim)).astype("float32")
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def recall_at_k(found, truth, k):
+    return np.mean([len(set(f[:k]) & set(t[:k])) / k for f, t in zip(found, truth)])
+
+
+def benchmark(vectors, queries, k=5):
+    n, dim = vectors.shape
+    ids = np.arange(n, dtype="int64")
+    exact = faiss.IndexFlatL2(dim)
+    exact.add(vectors)
+    _, truth = exact.search(queries, k)
+
+    print(f"{n} vectors, {len(queries)} queries, dim {dim}, re-rank factor {RERANK_FACTOR}")
+    print(f"{'index':<6} {'storage':<7} {'MB/1M chunks':>13} {'recall@5':>9} {'+rerank':>8} {'ms/query':>9}")
+    for kind, compression in CONFIGS:
+        started = time.perf_counter()
+        if kind == "flat":
+            index = faiss.IndexIDMap(make_flat_index(dim, compression))
+            if not index.is_trained:
+                index.train(vectors[:min(n, 65536)])
+            index.add_with_ids(vectors, ids)
+        else:
+            index = build_ann_index(dim, vectors, ids, kind, compression)
+        build_seconds = time.perf_counter() - started
+
+        megabytes = len(faiss.serialize_index(index)) / n  # bytes per chunk == MB per million chunks
+
+        started = time.perf_counter()
+        _, found = index.search(queries, k)
+        _, candidates = index.search(queries, k * RERANK_FACTOR)
+        reranked = []
+        for query, row in zip(queries, candidates):
+            row = row[row >= 0]
+            reranked.append(rerank(query, row, vectors[row], k)[1])
+        per_query = (time.perf_counter() - started) * 1000 / len(queries) / 2
+
+        print(f"{kind:<6} {compression:<7} {megabytes:>13.1f} {recall_at_k(found, truth, k):>9.3f} "
+              f"{recall_at_k(reranked, truth, k):>8.3f} {per_query:>9.3f}   (built in {build_seconds:.1f}s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark document index storage modes")
+    parser.add_argument("--vectors", help="raw float32 vector file, e.g. index_data/<app>/vectors.f32")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--n", type=int, default=100000, help="synthetic vectors to generate")
+    parser.add_argument("--queries", type=int, default=1000)
+    args = parser.parse_args()
+
+    if args.vectors:
+        vectors = np.fromfile(args.vectors, dtype="float32").reshape(-1, args.dim)
+    else:
+        vectors = synthetic_vectors(args.n + args.queries, args.dim)
+    queries = np.ascontiguousarray(vectors[-args.queries:])
+    vectors = np.ascontiguousarray(vectors[:-args.queries])
+    benchmark(vectors, queries)
+
+
+if __name__ == "__main__":
+    main()
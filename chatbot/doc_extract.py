@@ -0,0 +1,145 @@
+import os
+import codecs
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from lazy import lazy_import
+
+PyPDF2 = lazy_import("PyPDF2")
+docx = lazy_import("docx")
+
+# Streaming text extraction for uploaded documents. Every extractor yields the
+# document piece by piece (PDF page, DOCX paragraph, text line) so that chunking
+# and embedding can start before the whole file has been parsed.
+#
+# PDF and DOCX parsing is pure Python and holds the GIL, so files on disk are parsed
+# in a bounded process pool instead; PDFs are split into page ranges across workers.
+# Workers are spawned, not forked: forking the multi-threaded server (encoder, FAISS
+# and Socket.IO threads) can deadlock, and fork does not exist on Windows. The worker
+# functions below only need this module and the parsers. A spawned worker re-imports
+# the server's main module as __mp_main__, so the servers load encoders and open the
+# document index only on first use or under `if __name__ == "__main__"`, and
+# DocumentIndex refuses to open outside the main process. If the pool cannot be
+# started, files are parsed in-process.
+
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", str(min(4, os.cpu_count() or 1))))  # 0 parses in-process
+PAGES_PER_TASK = int(os.getenv("PAGES_PER_TASK", "8"))
+
+_pool = None
+_pool_failed = False
+_pool_lock = threading.Lock()
+
+
+def get_parse_pool():
+    """The shared parse pool, or None when PARSE_WORKERS is 0 or the pool cannot be started."""
+    global _pool, _pool_failed
+    with _pool_lock:
+        if _pool is None and PARSE_WORKERS > 0 and not _pool_failed:
+            try:
+                _pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+            except Exception as e:
+                print("Parse pool unavailable, parsing in-process:", e)
+                _pool_failed = True
+        return _pool
+
+
+def _pool_broke(e):
+    global _pool, _pool_failed
+    with _pool_lock:
+        if not _pool_failed:
+            print("Parse pool broke, parsing in-process:", e)
+        _pool, _pool_failed = None, True
+
+
+def _pooled(pool, func, *args):
+    """Run func on the parse pool; returns a callable giving its result, computed
+    in-process instead if the pool breaks (e.g. workers cannot start)."""
+    try:
+        future = pool.submit(func, *args)
+    except BrokenProcessPool as e:  # broke while earlier tasks of this file ran
+        _pool_broke(e)
+        return lambda: func(*args)
+
+    def result():
+        try:
+            return future.result()
+        except BrokenProcessPool as e:
+            _pool_broke(e)
+            return func(*args)
+    return result
+
+
+def iter_pdf_pages(source):
+    reader = PyPDF2.PdfReader(source)
+    for page in reader.pages:
+        text = page.extract_text()
+        if text:
+            yield text + "\n"
+
+
+def _extract_pdf_range(path, start, stop):
+    reader = PyPDF2.PdfReader(path)
+    pages = []
+    for page in reader.pages[start:stop]:
+        text = page.extract_text()
+        if text:
+            pages.append(text + "\n")
+    return pages
+
+
+def iter_pdf_pages_parallel(path, pages_per_task=PAGES_PER_TASK):
+    """Extract page ranges of a PDF on the parse pool and yield the pages in order."""
+    pool = get_parse_pool()
+    if pool is None:
+        yield from iter_pdf_pages(path)
+        return
+    total = len(PyPDF2.PdfReader(path).pages)
+    pending = deque()
+    for start in range(0, total, pages_per_task):
+        pending.append(_pooled(pool, _extract_pdf_range, path, start, min(start + pages_per_task, total)))
+        # Keep two ranges per worker in flight; results are consumed in page order
+        if len(pending) >= PARSE_WORKERS * 2:
+            yield from pending.popleft()()
+    while pending:
+        yield from pending.popleft()()
+
+
+def iter_docx_paragraphs(source):
+    for para in docx.Document(source).paragraphs:
+        yield para.text + "\n"
+
+
+def _extract_docx(path):
+    return [para.text + "\n" for para in docx.Document(path).paragraphs]
+
+
+def iter_docx_paragraphs_pooled(path):
+    pool = get_parse_pool()
+    if pool is None:
+        yield from iter_docx_paragraphs(path)
+        return
+    yield from _pooled(pool, _extract_docx, path)()
+
+
+def iter_txt_lines(source):
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "r", encoding="utf-8") as f:
+            yield from f
+    else:
+        yield from codecs.getreader("utf-8")(source)
+
+
+def iter_document_text(source, filename):
+    """Yield the text of a .pdf/.docx/.txt upload piece by piece; source is a path or a binary stream."""
+    name = filename.lower()
+    on_disk = isinstance(source, (str, os.PathLike)) and PARSE_WORKERS > 0
+    if name.endswith(".pdf"):
+        return iter_pdf_pages_parallel(source) if on_disk else iter_pdf_pages(source)
+    elif name.endswith(".docx"):
+        return iter_docx_paragraphs_pooled(source) if on_disk else iter_docx_paragraphs(source)
+    elif name.endswith(".txt"):
+        return iter_txt_lines(source)
+    else:
+        raise ValueError("Unsupported file type")
@@ -0,0 +1,1053 @@
+import os
+import re
+import time
+import uuid
+import zlib
+import hashlib
+import sqlite3
+import threading
+import multiprocessing
+from collections import OrderedDict, namedtuple
+import numpy as np
+from lazy import lazy_import
+
+faiss = lazy_import("faiss")
+
+# Shared document ingestion helpers for the chatbot apps and the Telegram bot.
+
+CHUNK_SIZE = 500
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+DOC_INDEX_DIR = os.getenv("DOC_INDEX_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "index_data"))
+
+# Exact flat search is used until a namespace holds ANN_THRESHOLD chunks (0 disables promotion)
+ANN_THRESHOLD = int(os.getenv("ANN_THRESHOLD", "20000"))
+ANN_TYPE = os.getenv("ANN_TYPE", "hnsw")  # "hnsw" or "ivf"
+ANN_NPROBE = int(os.getenv("ANN_NPROBE", "16"))  # IVF lists scanned per query
+ANN_EF_SEARCH = int(os.getenv("ANN_EF_SEARCH", "64"))  # HNSW candidate list size per query
+HNSW_M = 32
+
+# Compressed storage: "sq8" keeps 8-bit scalar-quantized vectors (4x smaller), "pq" uses
+# product quantization once a namespace is promoted; results are re-ranked exactly
+INDEX_COMPRESSION = os.getenv("INDEX_COMPRESSION", "none")  # "none", "sq8" or "pq"
+PQ_M = int(os.getenv("PQ_M", "48"))  # bytes per PQ code, must divide the embedding dimension
+RERANK_FACTOR = int(os.getenv("RERANK_FACTOR", "4"))  # candidates per result re-ranked with exact distances
+
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "1024"))
+RRF_K = 60  # reciprocal rank fusion constant for hybrid lexical + vector retrieval
+MAX_SEGMENTS = 8  # exhaustive-scan segments per namespace before they are merged
+
+# Context selection for document answers. Embeddings are unit length, so a squared L2
+# distance d corresponds to cosine similarity 1 - d / 2
+CONTEXT_MAX_DISTANCE = float(os.getenv("CONTEXT_MAX_DISTANCE", "1.2"))  # drop chunks below cosine 0.4
+CONTEXT_DISTANCE_MARGIN = float(os.getenv("CONTEXT_DISTANCE_MARGIN", "0.3"))  # adaptive k: stay this close to the best chunk
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "400"))
+CONTEXT_CANDIDATES = 10  # fused candidates considered per question
+MMR_LAMBDA = 0.7  # relevance vs. novelty trade-off when picking chunks
+DUPLICATE_SIMILARITY = 0.95  # chunks this similar to a picked one add nothing
+CHARS_PER_TOKEN = 4
+
+# Document lifecycle: expired and deleted documents are dropped by a background task
+DOC_TTL_SECONDS = float(os.getenv("DOC_TTL_SECONDS", "0"))  # default lifetime of an upload, 0 keeps it forever
+COMPACT_INTERVAL = float(os.getenv("COMPACT_INTERVAL", "600"))  # seconds between expiry and compaction runs
+COMPACT_MIN_DEAD_RATIO = float(os.getenv("COMPACT_MIN_DEAD_RATIO", "0.2"))  # rewrite the vector file past this share of dead rows
+
+Segment = namedtuple("Segment", ["kind", "index"])
+# Vector file with its chunk id -> row map; replaced as a whole when the file is compacted
+VectorStore = namedtuple("VectorStore", ["path", "rows", "vectors"])
+
+
+def make_flat_index(dim, compression=INDEX_COMPRESSION):
+    """Exhaustive-scan index over raw float32 or, when compressed, 8-bit quantized vectors."""
+    if compression == "none":
+        return faiss.IndexFlatL2(dim)
+    # PQ needs thousands of training vectors, so small namespaces use SQ8 until promoted
+    return faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_L2)
+
+
+def make_ann_index(dim, n, kind=ANN_TYPE, compression=INDEX_COMPRESSION):
+    """Untrained approximate index for n vectors of the given kind and compression."""
+    if kind == "ivf":
+        nlist = max(1, min(int(4 * np.sqrt(n)), n // 39))
+        quantizer = faiss.IndexFlatL2(dim)
+        if compression == "pq":
+            ann = faiss.IndexIVFPQ(quantizer, dim, nlist, PQ_M, 8)
+        elif compression == "sq8":
+            ann = faiss.IndexIVFScalarQuantizer(quantizer, dim, nlist, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_L2)
+        else:
+            ann = faiss.IndexIVFFlat(quantizer, dim, nlist)
+        ann.nprobe = ANN_NPROBE
+    elif kind == "hnsw":
+        if compression == "pq":
+            ann = faiss.IndexHNSWPQ(dim, PQ_M, HNSW_M)
+        elif compression == "sq8":
+            ann = faiss.IndexHNSWSQ(dim, faiss.ScalarQuantizer.QT_8bit, HNSW_M)
+        else:
+            ann = faiss.IndexHNSWFlat(dim, HNSW_M)
+        ann.hnsw.efSearch = ANN_EF_SEARCH
+    else:
+        raise ValueError(f"Unknown ANN index type: {kind}")
+    return ann
+
+
+def train_sample(vectors, size):
+    rows = np.random.default_rng(0).choice(len(vectors), min(len(vectors), size), replace=False)
+    return np.ascontiguousarray(vectors[np.sort(rows)])
+
+
+def build_ann_index(dim, vectors, ids, kind=ANN_TYPE, compression=INDEX_COMPRESSION):
+    """Train and fill an ID-mapped approximate index from the given vectors."""
+    ann = make_ann_index(dim, len(ids), kind, compression)
+    if not ann.is_trained:
+        ann.train(train_sample(vectors, max(65536, getattr(ann, "nlist", 0) * 64)))
+
+    index = faiss.IndexIDMap(ann)
+    for start in range(0, len(ids), 65536):
+        index.add_with_ids(np.ascontiguousarray(vectors[start:start+65536]), ids[start:start+65536])
+    return index
+
+
+def segment_ids(segment):
+    return faiss.vector_to_array(segment.index.id_map).astype("int64")
+
+
+def rerank(query_embedding, ids, vectors, top_k):
+    """Exact L2 re-ranking of candidate ids; vectors[i] holds the float32 vector of ids[i]."""
+    distances = np.sum((vectors - query_embedding.reshape(1, -1)) ** 2, axis=1)
+    order = np.argsort(distances)[:top_k]
+    return distances[order], ids[order]
+
+
+class NamespaceIndex:
+    """One namespace's vectors, held as a tuple of immutable index segments.
+
+    Writers are serialized: every added batch becomes a new exhaustive-scan segment,
+    and small segments are merged once there are more than MAX_SEGMENTS of them. Once
+    ANN_THRESHOLD vectors sit in exhaustive segments, they are rebuilt into one ANN
+    segment on a background thread. Every change publishes a new tuple with a single
+    assignment, so searches take no lock and always see a consistent snapshot.
+
+    Removed chunks are tombstoned: searches skip their ids until compact() rebuilds the
+    segments holding them (HNSW cannot remove vectors in place).
+    """
+
+    def __init__(self, dim, load_vectors, train_vectors=None):
+        self.dim = dim
+        self.segments = ()
+        self._load_vectors = load_vectors
+        # Trained but empty quantizer, cloned for every compressed flat segment
+        self._template = make_flat_index(dim)
+        if not self._template.is_trained and train_vectors is not None and len(train_vectors):
+            self._template.train(train_vectors)
+        self.deleted = np.empty(0, dtype="int64")  # sorted tombstoned ids
+        self._rebuilding = False
+        self._lock = threading.Lock()
+
+    @property
+    def ntotal(self):
+        """Live vectors, not counting tombstones."""
+        return sum(segment.index.ntotal for segment in self.segments) - len(self.deleted)
+
+    @property
+    def tombstones(self):
+        return len(self.deleted)
+
+    @property
+    def kind(self):
+        kinds = [segment.kind for segment in self.segments if segment.kind != "flat"]
+        return kinds[0] if kinds else "flat"
+
+    def _flat_segment(self, vectors, ids):
+        if not self._template.is_trained:
+            # Nothing stored yet to learn quantizer ranges from; use the first batch
+            self._template.train(vectors)
+        index = faiss.IndexIDMap(faiss.clone_index(self._template))
+        index.add_with_ids(vectors, ids)
+        return Segment("flat", index)
+
+    def add(self, vectors, ids):
+        with self._lock:
+            segments = self.segments + (self._flat_segment(vectors, ids),)
+            # Merging during a rebuild would mix its snapshot with newer segments
+            if not self._rebuilding and sum(segment.kind == "flat" for segment in segments) > MAX_SEGMENTS:
+                segments = self._merge_flat(segments)
+            self.segments = segments
+
+    def _merge_flat(self, segments):
+        flat = sorted((segment for segment in segments if segment.kind == "flat"),
+                      key=lambda segment: segment.index.ntotal, reverse=True)
+        # Tiered: leave the largest segment alone unless the rest have caught up with it,
+        # so every vector is copied O(log n) times
+        if flat[0].index.ntotal >= sum(segment.index.ntotal for segment in flat[1:]):
+            flat = flat[1:]
+        ids = np.concatenate([segment_ids(segment) for segment in flat])
+        merged = self._flat_segment(np.ascontiguousarray(self._load_vectors(ids)), ids)
+        merged_away = {id(segment) for segment in flat}
+        return tuple(segment for segment in segments if id(segment) not in merged_away) + (merged,)
+
+    def remove(self, ids):
+        with self._lock:
+            self.deleted = np.union1d(self.deleted, np.asarray(ids, dtype="int64"))
+
+    def search(self, query_embedding, top_k):
+        # compact() publishes new segments before it clears their tombstones
+        deleted = self.deleted
+        segments = self.segments
+        fetch = top_k + min(len(deleted), 3 * top_k)
+        if not segments:
+            return (np.full((len(query_embedding), top_k), np.inf, dtype="float32"),
+                    np.full((len(query_embedding), top_k), -1, dtype="int64"))
+        if len(segments) == 1:
+            distances, indices = segments[0].index.search(query_embedding, fetch)
+        else:
+            results = [segment.index.search(query_embedding, fetch) for segment in segments]
+            distances = np.hstack([d for d, _ in results])
+            indices = np.hstack([i for _, i in results])
+        if len(deleted):
+            # Tombstones sort after every live result
+            distances = np.where(np.isin(indices, deleted), np.inf, distances)
+            indices = np.where(np.isinf(distances), -1, indices)
+        if len(deleted) or len(segments) > 1:
+            order = np.argsort(distances, axis=1, kind="stable")
+            distances = np.take_along_axis(distances, order, axis=1)
+            indices = np.take_along_axis(indices, order, axis=1)
+        return distances[:, :top_k], indices[:, :top_k]
+
+    def should_promote(self):
+        if ANN_THRESHOLD <= 0 or self._rebuilding:
+            return False
+        return sum(segment.index.ntotal for segment in self.segments if segment.kind == "flat") >= ANN_THRESHOLD
+
+    def promote(self):
+        """Start a background rebuild of every current segment into one ANN_TYPE segment."""
+        with self._lock:
+            if not self.should_promote():
+                return
+            self._rebuilding = True
+            snapshot = self.segments
+            deleted = self.deleted
+        threading.Thread(target=self._promote, args=(snapshot, deleted), daemon=True).start()
+
+    def _promote(self, snapshot, deleted):
+        started = time.perf_counter()
+        try:
+            ids = np.concatenate([segment_ids(segment) for segment in snapshot])
+            ids = ids[~np.isin(ids, deleted)]
+            segment = Segment(ANN_TYPE, build_ann_index(self.dim, self._load_vectors(ids), ids))
+        except Exception as e:
+            print("ANN index build error:", e)
+            self._replace({}, ())
+            return
+        # Segments added during the build are kept next to the new one
+        replacements = {id(s): None for s in snapshot}
+        replacements[id(snapshot[0])] = segment
+        self._replace(replacements, deleted)
+        print(f"Promoted {segment.index.ntotal} vectors to {ANN_TYPE} in {time.perf_counter() - started:.2f}s")
+
+    def compact(self):
+        """Rebuild the segments holding tombstoned ids without them; returns the vectors dropped."""
+        with self._lock:
+            if self._rebuilding or not len(self.deleted):
+                return 0
+            self._rebuilding = True
+            snapshot = self.segments
+            deleted = self.deleted
+        replacements = {}
+        try:
+            for segment in snapshot:
+                ids = segment_ids(segment)
+                keep = ids[~np.isin(ids, deleted)]
+                if len(keep) == len(ids):
+                    continue
+                if not len(keep):
+                    replacements[id(segment)] = None
+                elif segment.kind == "flat" or len(keep) < ANN_THRESHOLD:
+                    replacements[id(segment)] = self._flat_segment(np.ascontiguousarray(self._load_vectors(keep)), keep)
+                else:
+                    replacements[id(segment)] = Segment(segment.kind, build_ann_index(
+                        self.dim, self._load_vectors(keep), keep, segment.kind))
+        except Exception as e:
+            print("Index compaction error:", e)
+            self._replace({}, ())
+            return 0
+        self._replace(replacements, deleted)
+        return len(deleted)
+
+    def _replace(self, replacements, deleted):
+        # Publish the rebuilt segments (id of old segment -> new one, or None to drop it)
+        # and forget the tombstones they no longer contain
+        with self._lock:
+            segments = (replacements.get(id(s), s) for s in self.segments)
+            self.segments = tuple(s for s in segments if s is not None)
+            self.deleted = np.setdiff1d(self.deleted, deleted)
+            self._rebuilding = False
+
+
+class DocumentIndex:
+    """FAISS indexes backed by an append-only vector file and a SQLite chunk store.
+
+    Vectors are appended to a raw float32 file and chunk texts go to ``chunks.db``,
+    where each chunk row records the file row holding its vector. Nothing is
+    re-embedded on restart: the vector file is memory-mapped and copied into FAISS on
+    first use, and texts are read from SQLite only for the ids a search returns.
+
+    Chunks are partitioned by namespace (a username or chat id). Every namespace gets
+    its own NamespaceIndex, so a search only scans the caller's own documents.
+
+    Uploaded files and chunks are keyed by content hash: a file already indexed in a
+    namespace is skipped outright, and a revised file only embeds the chunks that are
+    not stored yet.
+
+    Deleting or expiring a document removes the chunk texts no other document uses
+    and tombstones their vectors. compact() later rebuilds the in-memory segments
+    without them and rewrites the vector file once enough of it is dead; chunk ids
+    never change, only the rows they map to.
+
+    Writers are serialized by one lock. Readers never take it: searches run against the
+    namespace's published segments and SQLite reads use a per-thread connection, which
+    in WAL mode sees the last committed state while a write is in progress. Chunk rows
+    are committed before their vectors are published, so every id a search returns
+    already has its text.
+    """
+
+    def __init__(self, name, dim=384, data_dir=DOC_INDEX_DIR):
+        if multiprocessing.current_process().name != "MainProcess":
+            # A spawned parse worker re-imports the server's main module; its recovery and
+            # compaction would race the server's own writes to the same files
+            raise RuntimeError(f"document index {name!r} can only be opened by the main process")
+        self.dim = dim
+        self.path = os.path.join(data_dir, name)
+        os.makedirs(self.path, exist_ok=True)
+        self.db_path = os.path.join(self.path, "chunks.db")
+        self.compactions = 0
+
+        self._write_lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._local = threading.local()
+        self._indexes = {}
+        self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # A chunk's vector sits at row "row" of the vector file (row == id until the first compaction)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "id INTEGER PRIMARY KEY, text TEXT NOT NULL, namespace TEXT NOT NULL DEFAULT '', hash TEXT, "
+            "row INTEGER NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS chunks_namespace ON chunks (namespace, id)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS chunks_hash ON chunks (namespace, hash)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS chunks_row ON chunks (row)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "namespace TEXT NOT NULL, hash TEXT NOT NULL, filename TEXT, added_at REAL NOT NULL, "
+            "expires_at REAL, complete INTEGER NOT NULL DEFAULT 1, PRIMARY KEY (namespace, hash))"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS document_chunks ("
+            "namespace TEXT NOT NULL, doc_hash TEXT NOT NULL, chunk_id INTEGER NOT NULL, "
+            "PRIMARY KEY (namespace, doc_hash, chunk_id))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS document_chunks_chunk ON document_chunks (namespace, chunk_id)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        # BM25 inverted index over the chunk texts, stored once in the chunks table
+        self._db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5("
+                         "text, namespace, content='chunks', content_rowid='id')")
+        self._db.commit()
+        self._recover()
+
+    def _recover(self):
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'vectors_file'").fetchone()
+        vectors_file = row[0] if row else "vectors.f32"
+        path = os.path.join(self.path, vectors_file)
+        for name in os.listdir(self.path):
+            # Left behind by a compaction that was interrupted before it committed
+            if name.startswith("vectors") and name.endswith(".f32") and name != vectors_file:
+                os.remove(os.path.join(self.path, name))
+
+        # Vectors are written before the chunk rows and the row count are committed, so a
+        # crash can only leave extra vector rows behind; drop them. Dead rows of deleted
+        # chunks are still counted, so a clean restart never finds a difference.
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'rows_used'").fetchone()
+        rows = int(row[0]) if row else self._db.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM chunks").fetchone()[0]
+        row_bytes = self.dim * 4
+        if not os.path.exists(path):
+            open(path, "wb").close()
+        stored = os.path.getsize(path) // row_bytes
+        if stored != rows:
+            print(f"Index recovery: {stored} vector rows on disk, {rows} committed")
+            if stored < rows:
+                # The vector file lost committed rows; drop the chunks that pointed at them
+                self._db.execute("INSERT INTO chunks_fts (chunks_fts, rowid, text, namespace) "
+                                 "SELECT 'delete', id, text, namespace FROM chunks WHERE row >= ?", (stored,))
+                self._db.execute("DELETE FROM document_chunks WHERE chunk_id IN (SELECT id FROM chunks WHERE row >= ?)",
+                                 (stored,))
+                self._db.execute("DELETE FROM chunks WHERE row >= ?", (stored,))
+            rows = min(rows, stored)
+            with open(path, "r+b") as f:
+                f.truncate(rows * row_bytes)
+            self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rows_used', ?)", (str(rows),))
+            self._db.commit()
+
+        mapping = self._db.execute("SELECT id, row FROM chunks").fetchall()
+        self._next_id = max((i for i, _ in mapping), default=-1) + 1
+        self._live = len(mapping)
+        self._rows_used = rows
+        row_map = np.full(max(1024, self._next_id * 2), -1, dtype="int64")
+        if mapping:
+            ids, file_rows = np.array(mapping, dtype="int64").T
+            row_map[ids] = file_rows
+        self._store = VectorStore(path, row_map, self._map(path, rows))
+
+        # Documents whose indexing never finished (the process stopped mid-upload) are
+        # removed, so the next upload of the file indexes it again
+        incomplete = self._db.execute("SELECT namespace, hash FROM documents WHERE complete = 0").fetchall()
+        for namespace, doc_hash in incomplete:
+            self.delete_document(doc_hash, namespace)
+        if incomplete:
+            print(f"Index recovery: removed {len(incomplete)} partly indexed documents")
+
+    def _map(self, path, rows):
+        if rows == 0:
+            return np.empty((0, self.dim), dtype="float32")
+        return np.memmap(path, dtype="float32", mode="r", shape=(rows, self.dim))
+
+    def vectors(self):
+        """Memory-mapped view of every row of the vector file, dead rows included."""
+        return self._store.vectors
+
+    def _reader(self):
+        """This thread's read-only connection to the chunk store."""
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+            self._local.db = db
+        return db
+
+    def _load_vectors(self, ids):
+        store = self._store
+        return store.vectors[store.rows[ids]]
+
+    def get_vectors(self, ids):
+        """Stored float32 vectors of the given chunk ids, in order."""
+        return np.ascontiguousarray(self._load_vectors(np.asarray(ids, dtype="int64")), dtype="float32")
+
+    def _train_sample(self):
+        vectors = self.vectors()
+        if INDEX_COMPRESSION == "none" or len(vectors) == 0:
+            return None
+        return train_sample(vectors, 10000)
+
+    def index(self, namespace=""):
+        """The namespace's index, loaded from the vector file on first use."""
+        index = self._indexes.get(namespace)
+        if index is None:
+            with self._load_lock:
+                index = self._indexes.get(namespace)
+                if index is None:
+                    index = self._load_namespace(namespace)
+                    self._indexes[namespace] = index
+        if index.should_promote():
+            index.promote()
+        return index
+
+    def _load_namespace(self, namespace):
+        # Writers to this namespace wait on _load_lock in index() until it is published
+        started = time.perf_counter()
+        index = NamespaceIndex(self.dim, self._load_vectors, self._train_sample())
+        ids = np.array([row[0] for row in self._reader().execute(
+            "SELECT id FROM chunks WHERE namespace = ? ORDER BY id", (namespace,))], dtype="int64")
+        for start in range(0, len(ids), 65536):
+            batch = ids[start:start+65536]
+            index.add(np.ascontiguousarray(self._load_vectors(batch)), batch)
+        print(f"Loaded {index.ntotal} vectors for namespace '{namespace}' in {time.perf_counter() - started:.2f}s")
+        return index
+
+    @property
+    def ntotal(self):
+        """Live chunks across all namespaces."""
+        return self._live
+
+    def add(self, embeddings, chunks, namespace="", hashes=None):
+        """Persist a batch of embeddings with their chunk texts and return their ids."""
+        if hashes is None:
+            hashes = [content_hash(chunk.encode("utf-8")) for chunk in chunks]
+        index = self.index(namespace)
+        with self._write_lock:
+            store = self._store
+            ids = list(range(self._next_id, self._next_id + len(chunks)))
+            rows = list(range(self._rows_used, self._rows_used + len(chunks)))
+            with open(store.path, "ab") as f:
+                f.write(np.ascontiguousarray(embeddings, dtype="float32").tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            self._db.executemany("INSERT INTO chunks (id, text, namespace, hash, row) VALUES (?, ?, ?, ?, ?)",
+                                 [(i, chunk, namespace, h, r) for i, chunk, h, r in zip(ids, chunks, hashes, rows)])
+            self._db.executemany("INSERT INTO chunks_fts (rowid, text, namespace) VALUES (?, ?, ?)",
+                                 [(i, chunk, namespace) for i, chunk in zip(ids, chunks)])
+            self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rows_used', ?)",
+                             (str(self._rows_used + len(rows)),))
+            self._db.commit()
+
+            row_map = store.rows
+            if ids[-1] >= len(row_map):
+                row_map = np.concatenate([row_map, np.full(max(len(row_map), len(ids)), -1, dtype="int64")])
+            # Slots past the old ids are not visible to readers until the new store is published
+            row_map[ids] = rows
+            self._next_id += len(ids)
+            self._rows_used += len(rows)
+            self._live += len(ids)
+            self._store = VectorStore(store.path, row_map, self._map(store.path, self._rows_used))
+            index.add(embeddings, np.array(ids, dtype="int64"))
+        if index.should_promote():
+            index.promote()
+        return ids
+
+    def search(self, query_embedding, top_k, namespace=""):
+        index = self.index(namespace)
+        if INDEX_COMPRESSION == "none":
+            distances, indices = index.search(query_embedding, top_k)
+            return distances[0], indices[0]
+
+        # Quantized distances only pick candidates; order them by exact distance
+        _, candidates = index.search(query_embedding, top_k * RERANK_FACTOR)
+        candidates = candidates[0][candidates[0] >= 0]
+        distances, indices = rerank(query_embedding, candidates, self._load_vectors(candidates), top_k)
+        missing = top_k - len(indices)
+        return (np.concatenate([distances, np.full(missing, np.inf, dtype="float32")]),
+                np.concatenate([indices, np.full(missing, -1, dtype="int64")]))
+
+    def has_document(self, doc_hash, namespace=""):
+        """Whether the document is fully indexed in the namespace."""
+        row = self._reader().execute("SELECT 1 FROM documents WHERE namespace = ? AND hash = ? AND complete = 1",
+                                     (namespace, doc_hash)).fetchone()
+        return row is not None
+
+    def existing_chunks(self, hashes, namespace=""):
+        """Map the given chunk hashes that are already stored in the namespace to their ids."""
+        found = {}
+        unique = list(set(hashes))
+        for start in range(0, len(unique), 500):
+            batch = unique[start:start+500]
+            placeholders = ",".join("?" * len(batch))
+            found.update((h, i) for i, h in self._reader().execute(
+                f"SELECT id, hash FROM chunks WHERE namespace = ? AND hash IN ({placeholders})",
+                [namespace] + batch))
+        return found
+
+    def add_document(self, doc_hash, chunk_ids, namespace="", filename=None, ttl=None, complete=True):
+        """Record an uploaded document; it expires after ttl seconds (DOC_TTL_SECONDS by default, 0 never).
+
+        A document added with complete=False is still being indexed: has_document() ignores
+        it until complete_document(), and reopening the index deletes it.
+        """
+        ttl = DOC_TTL_SECONDS if ttl is None else ttl
+        now = time.time()
+        with self._write_lock:
+            self._db.execute("INSERT OR REPLACE INTO documents (namespace, hash, filename, added_at, expires_at, complete) "
+                             "VALUES (?, ?, ?, ?, ?, ?)",
+                             (namespace, doc_hash, filename, now, now + ttl if ttl > 0 else None, int(complete)))
+            self._link(doc_hash, chunk_ids, namespace)
+            self._db.commit()
+
+    def complete_document(self, doc_hash, namespace=""):
+        with self._write_lock:
+            self._db.execute("UPDATE documents SET complete = 1 WHERE namespace = ? AND hash = ?", (namespace, doc_hash))
+            self._db.commit()
+
+    def link_chunks(self, doc_hash, chunk_ids, namespace=""):
+        """Attach more chunks to a recorded document, e.g. each batch while it is being indexed."""
+        with self._write_lock:
+            self._link(doc_hash, chunk_ids, namespace)
+            self._db.commit()
+
+    def _link(self, doc_hash, chunk_ids, namespace):
+        # A reused chunk may have been deleted with another document since it was looked up
+        self._db.executemany("INSERT OR IGNORE INTO document_chunks (namespace, doc_hash, chunk_id) "
+                             "SELECT ?, ?, id FROM chunks WHERE id = ?",
+                             [(namespace, doc_hash, i) for i in chunk_ids])
+
+    def list_documents(self, namespace=""):
+        rows = self._reader().execute(
+            "SELECT d.hash, d.filename, d.added_at, d.expires_at, d.complete, COUNT(dc.chunk_id) FROM documents d "
+            "LEFT JOIN document_chunks dc ON dc.namespace = d.namespace AND dc.doc_hash = d.hash "
+            "WHERE d.namespace = ? GROUP BY d.hash ORDER BY d.added_at", (namespace,)).fetchall()
+        return [{"hash": h, "filename": filename, "added_at": added_at, "expires_at": expires_at,
+                 "complete": bool(complete), "chunks": chunks}
+                for h, filename, added_at, expires_at, complete, chunks in rows]
+
+    def delete_document(self, doc_hash, namespace=""):
+        """Remove a document and the chunks no other document in its namespace uses.
+
+        Returns the number of chunks removed, or None when the document is unknown.
+        """
+        with self._write_lock:
+            if not self._db.execute("SELECT 1 FROM documents WHERE namespace = ? AND hash = ?",
+                                    (namespace, doc_hash)).fetchone():
+                return None
+            ids = [row[0] for row in self._db.execute(
+                "SELECT chunk_id FROM document_chunks WHERE namespace = ? AND doc_hash = ? AND chunk_id NOT IN "
+                "(SELECT chunk_id FROM document_chunks WHERE namespace = ? AND doc_hash != ?)",
+                (namespace, doc_hash, namespace, doc_hash))]
+            self._db.execute("DELETE FROM document_chunks WHERE namespace = ? AND doc_hash = ?", (namespace, doc_hash))
+            self._db.execute("DELETE FROM documents WHERE namespace = ? AND hash = ?", (namespace, doc_hash))
+            for start in range(0, len(ids), 500):
+                batch = ids[start:start+500]
+                placeholders = ",".join("?" * len(batch))
+                # External-content FTS rows are deleted with the text they were indexed from
+                self._db.execute("INSERT INTO chunks_fts (chunks_fts, rowid, text, namespace) "
+                                 f"SELECT 'delete', id, text, namespace FROM chunks WHERE id IN ({placeholders})", batch)
+                self._db.execute(f"DELETE FROM chunks WHERE id IN ({placeholders})", batch)
+            self._db.commit()
+            self._live -= len(ids)
+            index = self._indexes.get(namespace)
+            if index is not None and ids:
+                index.remove(ids)
+        return len(ids)
+
+    def expire_documents(self, now=None):
+        """Delete every document past its expiry time; returns how many were deleted."""
+        expired = self._reader().execute(
+            "SELECT namespace, hash FROM documents WHERE expires_at IS NOT NULL AND expires_at <= ?",
+            (time.time() if now is None else now,)).fetchall()
+        for namespace, doc_hash in expired:
+            self.delete_document(doc_hash, namespace)
+        return len(expired)
+
+    def compact(self):
+        """Drop tombstoned vectors from memory and, once enough rows are dead, from the vector file."""
+        started = time.perf_counter()
+        dropped = sum(index.compact() for index in list(self._indexes.values()))
+        reclaimed = 0
+        if self._rows_used and (self._rows_used - self._live) / self._rows_used >= COMPACT_MIN_DEAD_RATIO:
+            reclaimed = self._compact_vectors()
+        if dropped or reclaimed:
+            self.compactions += 1
+            print(f"Compacted index: {dropped} tombstones dropped, {reclaimed} vector rows reclaimed "
+                  f"in {time.perf_counter() - started:.2f}s")
+        return dropped, reclaimed
+
+    def _compact_vectors(self):
+        # Copy the live rows into a new file and switch to it in the same transaction that
+        # renumbers the rows; readers keep using the old mapping until the swap
+        with self._write_lock:
+            store = self._store
+            mapping = self._db.execute("SELECT id, row FROM chunks ORDER BY row").fetchall()
+            ids = np.array([i for i, _ in mapping], dtype="int64")
+            rows = np.array([r for _, r in mapping], dtype="int64")
+            dead = self._rows_used - len(ids)
+            if dead <= 0:
+                return 0
+            name = f"vectors-{uuid.uuid4().hex[:8]}.f32"
+            path = os.path.join(self.path, name)
+            with open(path, "wb") as f:
+                for start in range(0, len(rows), 65536):
+                    f.write(np.ascontiguousarray(store.vectors[rows[start:start+65536]]).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            self._db.executemany("UPDATE chunks SET row = ? WHERE id = ?", zip(range(len(ids)), ids.tolist()))
+            self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('vectors_file', ?)", (name,))
+            self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rows_used', ?)", (str(len(ids)),))
+            self._db.commit()
+
+            row_map = np.full(len(store.rows), -1, dtype="int64")
+            row_map[ids] = np.arange(len(ids))
+            self._rows_used = len(ids)
+            self._store = VectorStore(path, row_map, self._map(path, len(ids)))
+            # Searches still reading the old memory map keep it until they finish
+            os.remove(store.path)
+        return dead
+
+    def start_maintenance(self, interval=COMPACT_INTERVAL):
+        """Expire documents and compact the index every interval seconds on a daemon thread."""
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.expire_documents()
+                    self.compact()
+                except Exception as e:
+                    print("Index maintenance error:", e)
+        threading.Thread(target=run, daemon=True).start()
+
+    def stats(self):
+        return {
+            "live_chunks": self._live,
+            "tombstoned_chunks": sum(index.tombstones for index in list(self._indexes.values())),
+            "dead_vector_rows": self._rows_used - self._live,
+            "vector_file_bytes": self._rows_used * self.dim * 4,
+            "loaded_namespaces": len(self._indexes),
+            "compactions": self.compactions,
+        }
+
+    def lexical_search(self, query, top_k, namespace="", required=None):
+        """BM25-ranked chunk ids for the query terms; with required, only chunks containing all of those terms."""
+        terms = fts_phrases(query)
+        if not terms:
+            return []
+        match = "text : (" + " OR ".join(terms) + ")"
+        required = fts_phrases(" ".join(required or []))
+        if required:
+            match = " AND ".join(f"text : {term}" for term in required) + " AND " + match
+        ns_tokens = _FTS_TOKEN.findall(namespace.lower())
+        if ns_tokens:
+            # Narrows the match to the namespace's postings; the join below checks it exactly
+            match = f'namespace : "{" ".join(ns_tokens)}" AND {match}'
+        rows = self._reader().execute(
+            "SELECT c.id FROM chunks_fts JOIN chunks c ON c.id = chunks_fts.rowid "
+            "WHERE chunks_fts MATCH ? AND c.namespace = ? ORDER BY bm25(chunks_fts, 1.0, 0.0) LIMIT ?",
+            (match, namespace, top_k)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def get_texts(self, ids):
+        ids = [int(i) for i in ids if i >= 0]
+        if not ids:
+            return []
+        placeholders = ",".join("?" * len(ids))
+        rows = dict(self._reader().execute(f"SELECT id, text FROM chunks WHERE id IN ({placeholders})", ids).fetchall())
+        return [rows[i] for i in ids if i in rows]
+
+
+def normalize_query(query):
+    return " ".join(query.lower().split())
+
+
+class QueryEmbeddingCache:
+    """Bounded LRU of normalized query text to its embedding.
+
+    all-MiniLM-L6-v2 lower-cases its input, so queries differing only in case or
+    whitespace share one entry. One process holds one embedding model, so the model is
+    not part of the key.
+    """
+
+    def __init__(self, maxsize=QUERY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def encode(self, embedding_model, query):
+        """Return the (1, dim) float32 embedding of query, running the model only on a miss."""
+        key = normalize_query(query)
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return embedding
+
+        embedding = embedding_model.encode(key, normalize_embeddings=True).reshape(1, -1).astype("float32")
+        embedding.setflags(write=False)
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = embedding
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return embedding
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+query_cache = QueryEmbeddingCache()
+
+
+def embed_query(embedding_model, query):
+    return query_cache.encode(embedding_model, query)
+
+
+_FTS_TOKEN = re.compile(r"[^\W_]+")
+# Words that name something exactly: section numbers ("4.2", "3.1b"), short labels
+# ("7b", "q3", "x2") and formulas ("x^2+3x", "a=b"). Plain numbers ("in 2 lines") and
+# ordinals ("2nd") are ordinary words.
+_SECTION_NUMBER = re.compile(r"^\d+(\.\d+)+[a-z]?$")
+_LABEL = re.compile(r"^([a-z]{1,2}\d+[a-z]?|\d+[a-z])$")
+_ORDINAL = re.compile(r"^\d+(st|nd|rd|th)$")
+_FORMULA = re.compile(r"\w\s*[\^+=*/]\s*\w")
+
+
+def fts_phrases(text):
+    """Quote every whitespace-separated word as an FTS5 phrase of its alphanumeric tokens.
+
+    Matches the unicode61 tokenizer, so "4.2" becomes the phrase "4 2" and "x^2+3x"
+    becomes "x 2 3x"; no FTS5 query syntax from user input survives the quoting.
+    """
+    phrases = []
+    for word in text.lower().split():
+        tokens = _FTS_TOKEN.findall(word)
+        if tokens:
+            phrases.append('"' + " ".join(tokens) + '"')
+    return phrases
+
+
+def exact_terms(query):
+    """Words that name something exactly, e.g. "4.2", "7b" or "x^2+3x"."""
+    terms = []
+    for word in query.lower().split():
+        word = word.strip(".,;:!?\"'()[]{}")
+        if _SECTION_NUMBER.match(word) or (_LABEL.match(word) and not _ORDINAL.match(word)) or _FORMULA.search(word):
+            terms.append(word)
+    return terms
+
+
+def fused_search(embedding_model, doc_index, query, top_k=5, namespace=""):
+    """Reciprocal rank fusion of the BM25 and vector rankings."""
+    lexical = doc_index.lexical_search(query, top_k * 2, namespace)
+    _, vector = doc_index.search(embed_query(embedding_model, query), top_k * 2, namespace)
+    scores = {}
+    for ranking in (lexical, [int(i) for i in vector if i >= 0]):
+        for rank, chunk_id in enumerate(ranking):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)[:top_k]
+
+
+class ContextStats:
+    """Running totals of how much document context was selected per question."""
+
+    def __init__(self):
+        self.questions = 0
+        self.empty = 0
+        self.chunks = 0
+        self.tokens = 0
+        self._lock = threading.Lock()
+
+    def record(self, texts):
+        with self._lock:
+            self.questions += 1
+            self.empty += not texts
+            self.chunks += len(texts)
+            self.tokens += sum(estimate_tokens(text) for text in texts)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "questions": self.questions,
+                "no_context_rate": self.empty / self.questions if self.questions else 0.0,
+                "avg_chunks": self.chunks / self.questions if self.questions else 0.0,
+                "avg_tokens": self.tokens / self.questions if self.questions else 0.0,
+            }
+
+
+context_stats = ContextStats()
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def mmr_order(query_embedding, vectors, lambda_=MMR_LAMBDA):
+    """Maximal marginal relevance order of the rows of vectors (all unit length).
+
+    Rows nearly identical to an already picked row are left out.
+    """
+    relevance = vectors @ query_embedding.reshape(-1)
+    similarity = vectors @ vectors.T
+    order = []
+    remaining = list(range(len(vectors)))
+    while remaining:
+        redundancy = similarity[np.ix_(remaining, order)].max(axis=1) if order else np.zeros(len(remaining))
+        best = int(np.argmax(lambda_ * relevance[remaining] - (1 - lambda_) * redundancy))
+        if redundancy[best] < DUPLICATE_SIMILARITY:
+            order.append(remaining[best])
+        remaining.pop(best)
+    return order
+
+
+def fit_budget(texts, token_budget=CONTEXT_TOKEN_BUDGET):
+    """The leading texts that fit in token_budget; texts that would overflow it are skipped."""
+    selected = []
+    for text in texts:
+        tokens = estimate_tokens(text)
+        if tokens <= token_budget:
+            selected.append(text)
+            token_budget -= tokens
+    return selected
+
+
+def select_context(embedding_model, doc_index, query, namespace="", max_chunks=5,
+                   token_budget=CONTEXT_TOKEN_BUDGET):
+    """Chunk texts worth putting in the prompt for query; empty when nothing is relevant.
+
+    Exact-reference questions first try the chunks containing every referenced term,
+    falling back to fused candidates when none of those is relevant. Candidates are
+    compared with the question using their stored vectors: chunks beyond
+    CONTEXT_MAX_DISTANCE or more than CONTEXT_DISTANCE_MARGIN behind the best one are
+    dropped, the rest are ordered by maximal marginal relevance so near-duplicates fall
+    to the end, and chunks are taken until max_chunks or token_budget is reached.
+    """
+    if doc_index.index(namespace).ntotal == 0:
+        context_stats.record([])
+        return []
+    query_embedding = embed_query(embedding_model, query)
+    texts = []
+    required = exact_terms(query)
+    if required:
+        ids = doc_index.lexical_search(query, max_chunks, namespace, required)
+        texts = relevant_texts(doc_index, query_embedding, ids, max_chunks, token_budget)
+    if not texts:
+        ids = fused_search(embedding_model, doc_index, query, CONTEXT_CANDIDATES, namespace)
+        texts = relevant_texts(doc_index, query_embedding, ids, max_chunks, token_budget)
+    context_stats.record(texts)
+    return texts
+
+
+def relevant_texts(doc_index, query_embedding, ids, max_chunks, token_budget):
+    """Texts of the candidate ids that pass the distance cutoffs, in MMR order."""
+    ids = np.array(ids, dtype="int64")
+    if not len(ids):
+        return []
+    vectors = doc_index.get_vectors(ids)
+    distances = np.sum((vectors - query_embedding) ** 2, axis=1)
+    keep = distances <= min(CONTEXT_MAX_DISTANCE, distances.min() + CONTEXT_DISTANCE_MARGIN)
+    ids, vectors = ids[keep], vectors[keep]
+    if not len(ids):
+        return []
+    ids = ids[mmr_order(query_embedding, vectors)][:max_chunks]
+    return fit_budget(doc_index.get_texts(ids), token_budget)
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def stream_hash(f, block_size=1 << 20):
+    """SHA-256 of a binary stream, read block by block."""
+    digest = hashlib.sha256()
+    for block in iter(lambda: f.read(block_size), b""):
+        digest.update(block)
+    return digest.hexdigest()
+
+
+def _iter_lines(pieces, size):
+    # Re-split a stream of text pieces into lines, carrying partial lines over to the
+    # next piece. A partial line never grows past size characters.
+    partial = ""
+    for piece in pieces:
+        lines = (partial + piece).splitlines(keepends=True)
+        partial = lines.pop() if lines and not lines[-1].endswith(("\n", "\r")) else ""
+        yield from lines
+        while len(partial) > size:
+            yield partial[:size]
+            partial = partial[size:]
+    if partial:
+        yield partial
+
+
+def iter_chunks(pieces, size=CHUNK_SIZE):
+    """Pack whole lines from a stream of text pieces into chunks of at most size characters.
+
+    Once a chunk is half full it also ends after any line whose checksum hits a fixed
+    pattern. Those content-defined edges line up again right after an edit, so a revised
+    document only changes the chunks around the edit instead of shifting every chunk
+    after it. Lines longer than size are split.
+    """
+    current = ""
+    for line in _iter_lines(pieces, size):
+        while len(line) > size:
+            if current:
+                yield current
+                current = ""
+            yield line[:size]
+            line = line[size:]
+        if len(current) + len(line) > size:
+            yield current
+            current = ""
+        current += line
+        if len(current) >= size // 2 and zlib.crc32(line.encode("utf-8")) % 4 == 0:
+            yield current
+            current = ""
+    if current:
+        yield current
+
+
+def chunk_text(text, size=CHUNK_SIZE):
+    return list(iter_chunks([text], size))
+
+
+def embed_chunks(embedding_model, chunks, batch_size=EMBED_BATCH_SIZE):
+    """Encode chunks batch by batch into one contiguous float32 matrix."""
+    dim = embedding_model.get_sentence_embedding_dimension()
+    embeddings = np.empty((len(chunks), dim), dtype="float32")
+
+    for start in range(0, len(chunks), batch_size):
+        batch = chunks[start:start+batch_size]
+        embeddings[start:start+len(batch)] = embedding_model.encode(
+            batch,
+            batch_size=batch_size,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=False
+        )
+    return embeddings
+
+
+def index_chunks(embedding_model, doc_index, chunks, namespace="", doc_hash=None, filename=None,
+                 batch_size=EMBED_BATCH_SIZE, progress=None):
+    """Embed and store chunks batch by batch as they arrive and return all chunk ids.
+
+    chunks may be any iterable, e.g. iter_chunks() over a page-by-page extractor, so
+    at most one batch is held in memory and every batch is searchable as soon as it
+    has been added. Chunks already stored in the namespace are not embedded again.
+    progress(count) is called with the number of chunks handled after every batch.
+
+    With doc_hash, the document is recorded before its first chunk is stored and every
+    batch is linked to it as it lands, so deleting or expiring the document always
+    reaches its chunks. It is marked complete after the last batch; if indexing fails,
+    the partly indexed document is deleted again, and if the process stops first,
+    reopening the index deletes it.
+    """
+    started = time.perf_counter()
+    chunk_ids = []
+    seen = {}
+    new_count = 0
+    batch = []
+
+    def flush():
+        nonlocal new_count
+        hashes = [content_hash(chunk.encode("utf-8")) for chunk in batch]
+        seen.update(doc_index.existing_chunks([h for h in hashes if h not in seen], namespace))
+        new_chunks = {}
+        for h, chunk in zip(hashes, batch):
+            if h not in seen and h not in new_chunks:
+                new_chunks[h] = chunk
+        if new_chunks:
+            embeddings = embed_chunks(embedding_model, list(new_chunks.values()), batch_size)
+            seen.update(zip(new_chunks, doc_index.add(embeddings, list(new_chunks.values()), namespace, list(new_chunks))))
+            new_count += len(new_chunks)
+        batch_ids = [seen[h] for h in hashes]
+        if doc_hash:
+            doc_index.link_chunks(doc_hash, batch_ids, namespace)
+        chunk_ids.extend(batch_ids)
+        batch.clear()
+        if progress:
+            progress(len(chunk_ids))
+
+    if doc_hash:
+        doc_index.add_document(doc_hash, [], namespace, filename, complete=False)
+    try:
+        for chunk in chunks:
+            batch.append(chunk)
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+        if doc_hash:
+            doc_index.complete_document(doc_hash, namespace)
+    except BaseException:
+        if doc_hash:
+            doc_index.delete_document(doc_hash, namespace)
+        raise
+    elapsed = time.perf_counter() - started
+
+    rate = new_count / elapsed if elapsed > 0 else float("inf")
+    print(f"Indexed {new_count} new chunks ({len(chunk_ids) - new_count} already stored) "
+          f"in {elapsed:.2f}s ({rate:.1f} chunks/sec, batch size {batch_size})")
+    return chunk_ids
@@ -0,0 +1,171 @@
+import os
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from flask import Flask, request, jsonify
+from doc_index import DocumentIndex, context_stats, embed_query, query_cache, select_context
+from encoders import EMBED_BACKEND, load_encoder
+from retrieval_client import index_file
+
+# Shared embedding + retrieval service for the chatbot apps and the Telegram bot. One
+# process holds the encoder and the document index; front ends reach it through
+# RetrievalClient (retrieval_client.py):
+#
+#   python embed_service.py
+#   EMBED_SERVICE_URL=http://127.0.0.1:8765 python main.py
+#
+# Listens on localhost only; /index reads uploads from paths on the same machine.
+
+EMBED_SERVICE_PORT = int(os.getenv("EMBED_SERVICE_PORT", "8765"))
+MICRO_BATCH_SIZE = int(os.getenv("MICRO_BATCH_SIZE", "64"))  # sentences per shared forward pass
+MICRO_BATCH_WAIT_MS = float(os.getenv("MICRO_BATCH_WAIT_MS", "5"))  # how long a batch waits for company
+
+
+class MicroBatcher:
+    """Encoder wrapper that merges concurrent encode() calls into shared forward passes.
+
+    The first waiting request opens a batch, and requests arriving within max_wait_ms
+    join it until it holds max_batch sentences. Embeddings are always L2-normalized
+    float32, which is what every caller in doc_index asks for.
+    """
+
+    def __init__(self, model, max_batch=MICRO_BATCH_SIZE, max_wait_ms=MICRO_BATCH_WAIT_MS):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.batches = 0
+        self.requests = 0
+        self.sentences = 0
+        self._queue = queue.Queue()
+        threading.Thread(target=self._worker, daemon=True).start()
+
+    def get_sentence_embedding_dimension(self):
+        return self.model.get_sentence_embedding_dimension()
+
+    def encode(self, sentences, **kwargs):
+        single = isinstance(sentences, str)
+        future = Future()
+        self._queue.put(([sentences] if single else list(sentences), future))
+        embeddings = future.result()
+        return embeddings[0] if single else embeddings
+
+    def _worker(self):
+        while True:
+            pending = [self._queue.get()]
+            count = len(pending[0][0])
+            deadline = time.monotonic() + self.max_wait
+            while count < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    pending.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+                count += len(pending[-1][0])
+
+            texts = [text for batch, _ in pending for text in batch]
+            try:
+                embeddings = self.model.encode(texts, batch_size=self.max_batch, normalize_embeddings=True,
+                                               convert_to_numpy=True, show_progress_bar=False).astype("float32")
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.requests += len(pending)
+            self.sentences += len(texts)
+            start = 0
+            for batch, future in pending:
+                future.set_result(embeddings[start:start+len(batch)])
+                start += len(batch)
+
+    def stats(self):
+        return {
+            "forward_passes": self.batches,
+            "requests": self.requests,
+            "sentences": self.sentences,
+            "avg_requests_per_pass": self.requests / self.batches if self.batches else 0.0,
+        }
+
+
+app = Flask(__name__)
+
+# Set up by main(), not at import: spawned document parse workers (doc_extract.py)
+# re-import this module as __mp_main__ and must not load an encoder or open the index
+embedding_model = None
+doc_index = None
+
+
+@app.route("/embed", methods=["POST"])
+def embed():
+    texts = request.get_json().get("texts", [])
+    return jsonify({"embeddings": embedding_model.encode(texts).tolist() if texts else []})
+
+
+@app.route("/embed_query", methods=["POST"])
+def embed_one_query():
+    query = request.get_json().get("query", "")
+    return jsonify({"embedding": embed_query(embedding_model, query)[0].tolist()})
+
+
+@app.route("/context", methods=["POST"])
+def context():
+    data = request.get_json()
+    chunks = select_context(embedding_model, doc_index, data["query"], data.get("namespace", ""),
+                            max_chunks=int(data.get("max_chunks", 5)))
+    return jsonify({"chunks": chunks})
+
+
+@app.route("/index", methods=["POST"])
+def index():
+    data = request.get_json()
+    progress = {"chunks": 0}
+    try:
+        indexed = index_file(embedding_model, doc_index, data["path"], data["filename"], data.get("namespace", ""),
+                             lambda chunks: progress.update(chunks=chunks))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"indexed": indexed, "chunks": progress["chunks"]})
+
+
+@app.route("/documents", methods=["GET"])
+def list_documents():
+    return jsonify({"documents": doc_index.list_documents(request.args.get("namespace", ""))})
+
+
+@app.route("/documents/<doc_hash>", methods=["DELETE"])
+def delete_document(doc_hash):
+    removed = doc_index.delete_document(doc_hash, request.args.get("namespace", ""))
+    if removed is None:
+        return jsonify({"error": "Unknown document"}), 404
+    return jsonify({"deleted": doc_hash, "chunks_removed": removed})
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return jsonify({
+        "encoder_backend": EMBED_BACKEND,
+        "micro_batching": embedding_model.stats(),
+        "query_embedding_cache": query_cache.stats(),
+        "context_selection": context_stats.stats(),
+        "document_index": doc_index.stats()
+    })
+
+
+@app.route("/health", methods=["GET"])
+def health():
+    return jsonify({"status": "ok"})
+
+
+def main():
+    global embedding_model, doc_index
+    embedding_model = MicroBatcher(load_encoder())
+    doc_index = DocumentIndex("shared", embedding_model.get_sentence_embedding_dimension())
+    doc_index.start_maintenance()  # drops expired uploads and reclaims deleted chunks
+    app.run(host="127.0.0.1", port=EMBED_SERVICE_PORT, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
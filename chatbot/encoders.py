@@ -0,0 +1,120 @@
+import os
+import numpy as np
+
+# Sentence encoders for document and query embeddings. EMBED_BACKEND picks the runtime:
+#
+#   torch      sentence-transformers on PyTorch
+#   onnx       the same transformer exported to ONNX and run on onnxruntime
+#   onnx-int8  the ONNX export with int8 dynamic quantization of its weights
+#
+# The first ONNX load exports the model into ONNX_DIR, which needs torch and
+# sentence-transformers; later loads only need onnxruntime and tokenizers.
+
+EMBED_MODEL_NAME = "all-MiniLM-L6-v2"
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "torch")
+ONNX_DIR = os.getenv("ONNX_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "onnx_models"))
+ONNX_THREADS = int(os.getenv("ONNX_THREADS", "0"))  # 0 lets onnxruntime use every core
+MAX_SEQ_LENGTH = 256  # all-MiniLM-L6-v2 truncates its input here
+ONNX_INPUTS = ["input_ids", "attention_mask", "token_type_ids"]
+
+
+def export_onnx(model_name=EMBED_MODEL_NAME, quantize=False):
+    """Export model_name's transformer and tokenizer to ONNX_DIR once; return the .onnx path."""
+    out_dir = os.path.join(ONNX_DIR, model_name)
+    model_path = os.path.join(out_dir, "model.onnx")
+    if not os.path.exists(model_path):
+        import torch
+        from sentence_transformers import SentenceTransformer
+        print(f"Exporting {model_name} to ONNX in {out_dir}")
+        st_model = SentenceTransformer(model_name, device="cpu")
+        transformer = st_model[0].auto_model.eval()
+        transformer.config.return_dict = False
+        os.makedirs(out_dir, exist_ok=True)
+        st_model.tokenizer.save_pretrained(out_dir)  # tokenizer.json is all the runtime needs
+
+        sample = st_model.tokenizer(["a sample sentence"], return_tensors="pt")
+        tmp_path = f"{model_path}.{os.getpid()}.tmp"
+        with torch.no_grad():
+            torch.onnx.export(
+                transformer,
+                tuple(sample[name] for name in ONNX_INPUTS),
+                tmp_path,
+                input_names=ONNX_INPUTS,
+                output_names=["last_hidden_state"],
+                dynamic_axes={name: {0: "batch", 1: "sequence"} for name in ONNX_INPUTS + ["last_hidden_state"]},
+                opset_version=14,
+            )
+        os.replace(tmp_path, model_path)
+
+    if not quantize:
+        return model_path
+    quantized_path = os.path.join(out_dir, "model-int8.onnx")
+    if not os.path.exists(quantized_path):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        tmp_path = f"{quantized_path}.{os.getpid()}.tmp"
+        quantize_dynamic(model_path, tmp_path, weight_type=QuantType.QInt8)
+        os.replace(tmp_path, quantized_path)
+    return quantized_path
+
+
+class OnnxEncoder:
+    """Drop-in for SentenceTransformer.encode on onnxruntime.
+
+    Mirrors all-MiniLM-L6-v2's sentence-transformers pipeline: WordPiece tokenization
+    truncated to MAX_SEQ_LENGTH, the transformer, mean pooling over real tokens and
+    optional L2 normalization.
+    """
+
+    def __init__(self, model_name=EMBED_MODEL_NAME, quantized=False):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        model_path = export_onnx(model_name, quantize=quantized)
+        self.tokenizer = Tokenizer.from_file(os.path.join(os.path.dirname(model_path), "tokenizer.json"))
+        self.tokenizer.enable_truncation(MAX_SEQ_LENGTH)
+        self.tokenizer.enable_padding(pad_id=self.tokenizer.token_to_id("[PAD]"), pad_token="[PAD]")
+
+        options = ort.SessionOptions()
+        if ONNX_THREADS:
+            options.intra_op_num_threads = ONNX_THREADS
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.dim = self.session.get_outputs()[0].shape[-1]
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    def encode(self, sentences, batch_size=32, normalize_embeddings=False, convert_to_numpy=True,
+               show_progress_bar=False, **kwargs):
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        embeddings = np.empty((len(texts), self.dim), dtype="float32")
+
+        # Longest first, so each batch is padded to similar lengths
+        order = np.argsort([-len(text) for text in texts], kind="stable")
+        for start in range(0, len(texts), batch_size):
+            rows = order[start:start+batch_size]
+            encodings = self.tokenizer.encode_batch([texts[i] for i in rows])
+            mask = np.array([e.attention_mask for e in encodings], dtype="int64")
+            feeds = {
+                "input_ids": np.array([e.ids for e in encodings], dtype="int64"),
+                "attention_mask": mask,
+                "token_type_ids": np.array([e.type_ids for e in encodings], dtype="int64"),
+            }
+            hidden = self.session.run(None, {k: v for k, v in feeds.items() if k in self.input_names})[0]
+            weights = mask[:, :, None].astype("float32")
+            embeddings[rows] = (hidden * weights).sum(axis=1) / np.clip(weights.sum(axis=1), 1e-9, None)
+
+        if normalize_embeddings:
+            embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        return embeddings[0] if single else embeddings
+
+
+def load_encoder(backend=EMBED_BACKEND, model_name=EMBED_MODEL_NAME):
+    """The sentence encoder for the given backend: "torch", "onnx" or "onnx-int8"."""
+    if backend == "torch":
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(model_name)
+    if backend in ("onnx", "onnx-int8"):
+        return OnnxEncoder(model_name, quantized=backend == "onnx-int8")
+    raise ValueError(f"Unknown EMBED_BACKEND: {backend}")
@@ -0,0 +1,55 @@
+import os
+import sys
+import argparse
+import subprocess
+from collections import defaultdict
+
+# Import-time report for an app module, summarizing `python -X importtime`: the time
+# spent importing each top-level package (its modules' self times) and the total. With
+# --budget it exits non-zero when the total exceeds it, to catch startup regressions.
+#
+#   python import_report.py                  # main.py
+#   python import_report.py workhistapp --top 30 --budget 1.5
+
+
+def import_times(module):
+    """(module name, self seconds) for every module imported while importing module."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        sys.exit(f"import {module} failed: {result.stderr.strip().splitlines()[-1]}")
+
+    times = []
+    for line in result.stderr.splitlines():
+        # "import time:       412 |       1187 |   numpy.core"
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        times.append((name.strip(), int(self_us) / 1e6))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize the import time of a chatbot module")
+    parser.add_argument("module", nargs="?", default="main")
+    parser.add_argument("--top", type=int, default=20, help="packages to list")
+    parser.add_argument("--budget", type=float, help="fail when the total exceeds this many seconds")
+    args = parser.parse_args()
+
+    packages = defaultdict(float)
+    for name, seconds in import_times(args.module):
+        packages[name.split(".")[0]] += seconds
+    total = sum(packages.values())
+
+    print(f"{'package':<40} {'seconds':>8} {'share':>6}")
+    for name, seconds in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"{name:<40} {seconds:>8.3f} {seconds / total if total else 0:>6.1%}")
+    print(f"{'total':<40} {total:>8.3f}")
+
+    if args.budget is not None and total > args.budget:
+        print(f"Import time {total:.3f}s exceeds the budget of {args.budget:.3f}s")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
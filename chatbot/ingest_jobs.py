@@ -0,0 +1,104 @@
+import os
+import time
+import uuid
+import queue
+import threading
+from collections import OrderedDict
+
+# Background document ingestion: uploads are queued and indexed by worker threads so
+# the HTTP request that delivered the file can return immediately.
+
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+MAX_TRACKED_JOBS = 1000
+
+
+class IngestQueue:
+    """Runs ingest(path, filename, namespace, progress) for queued uploads on worker threads.
+
+    ingest returns False when the document was already indexed and calls
+    progress(chunks) after every stored batch. on_update(job) is called with a copy of
+    the job state whenever it changes, e.g. to push it over Socket.IO.
+    """
+
+    def __init__(self, ingest, workers=INGEST_WORKERS, on_update=None):
+        self.ingest = ingest
+        self.on_update = on_update
+        self._jobs = OrderedDict()
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        for _ in range(workers):
+            threading.Thread(target=self._worker, daemon=True).start()
+
+    def submit(self, path, filename, namespace=""):
+        """Queue a file saved at path (deleted once indexed) and return its job id."""
+        job_id = uuid.uuid4().hex
+        job = {
+            "job_id": job_id,
+            "filename": filename,
+            "namespace": namespace,
+            "status": "queued",
+            "chunks": 0,
+            "error": None,
+            "created_at": time.time(),
+            "finished_at": None,
+        }
+        with self._lock:
+            self._jobs[job_id] = job
+            while len(self._jobs) > MAX_TRACKED_JOBS:
+                self._jobs.popitem(last=False)
+        self._queue.put((job_id, path))
+        self._notify(job_id)
+        return job_id
+
+    def status(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def wait(self, job_id, timeout):
+        """Block until the job finishes or timeout seconds pass; return its status."""
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                job = self._jobs.get(job_id)
+                remaining = deadline - time.monotonic()
+                if job is None or job["finished_at"] is not None or remaining <= 0:
+                    return dict(job) if job else None
+                self._changed.wait(remaining)
+
+    def _update(self, job_id, **fields):
+        with self._changed:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(fields)
+            self._changed.notify_all()
+        self._notify(job_id)
+
+    def _notify(self, job_id):
+        if self.on_update:
+            job = self.status(job_id)
+            if job:
+                try:
+                    self.on_update(job)
+                except Exception as e:
+                    print("Ingest status update error:", e)
+
+    def _worker(self):
+        while True:
+            job_id, path = self._queue.get()
+            job = self.status(job_id)
+            try:
+                if job is None:
+                    continue
+                self._update(job_id, status="running")
+                indexed = self.ingest(path, job["filename"], job["namespace"],
+                                      lambda chunks: self._update(job_id, chunks=chunks))
+                self._update(job_id, status="done" if indexed else "duplicate", finished_at=time.time())
+            except Exception as e:
+                print(f"Ingest job {job_id} failed:", e)
+                self._update(job_id, status="failed", error=str(e), finished_at=time.time())
+            finally:
+                if os.path.exists(path):
+                    os.remove(path)
+                self._queue.task_done()
@@ -0,0 +1,97 @@
+import os
+import re
+import json
+import threading
+import numpy as np
+from intent_rules import is_multi_request, parse_time
+
+# Local intent classifier: nearest centroid over sentence embeddings (the MiniLM encoder
+# that already serves document retrieval) of the labelled examples in
+# intent_examples.json. A message is split into clauses ("..., then ...", sentences),
+# each clause gets the intent whose centroid it is closest to, and the whole message
+# goes to the LLM classifier instead when any clause is below INTENT_CONFIDENCE, is
+# less than INTENT_MARGIN closer to its intent than to the runner-up, or still looks
+# like several requests (is_multi_request), which the clause split cannot separate.
+
+INTENT_EXAMPLES = os.getenv("INTENT_EXAMPLES", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                            "intent_examples.json"))
+INTENT_CONFIDENCE = float(os.getenv("INTENT_CONFIDENCE", "0.7"))  # softmax probability of the best intent
+INTENT_MARGIN = float(os.getenv("INTENT_MARGIN", "0.1"))  # cosine gap between the best and second intent
+INTENT_TEMPERATURE = 0.05  # cosine similarities are close together; sharpen them before the softmax
+CLAUSE_SPLIT = re.compile(r"(?<=[.!?])\s+|;\s*|,?\s+\b(?:and then|and also|then|also)\b\s+", re.IGNORECASE)
+TIMED_INTENTS = ("study_schedule", "set_reminder")
+
+
+class IntentClassifier:
+    """Nearest-centroid classifier over embed(texts) -> list of unit-length vectors.
+
+    With embed_query(text) -> unit-length vector, messages are embedded through it
+    instead (e.g. RetrievalClient.embed_query, whose cache retrieval reuses); the
+    examples are always embedded with embed. The centroids are computed by fit(), or on
+    first use, so creating one does not load the encoder.
+    """
+
+    def __init__(self, embed, examples_path=INTENT_EXAMPLES, min_confidence=INTENT_CONFIDENCE,
+                 min_margin=INTENT_MARGIN, embed_query=None):
+        self.embed = embed
+        self.embed_query = embed_query
+        self.examples_path = examples_path
+        self.min_confidence = min_confidence
+        self.min_margin = min_margin
+        self.labels = None
+        self.centroids = None
+        self._lock = threading.Lock()
+
+    def fit(self):
+        with self._lock:
+            if self.centroids is None:
+                with open(self.examples_path, encoding="utf-8") as f:
+                    examples = json.load(f)
+                labels = sorted(examples)
+                texts = [text for label in labels for text in examples[label]]
+                vectors = np.asarray(self.embed(texts), dtype="float32")
+                centroids, start = [], 0
+                for label in labels:
+                    centroids.append(vectors[start:start+len(examples[label])].mean(axis=0))
+                    start += len(examples[label])
+                centroids = np.stack(centroids)
+                self.centroids = centroids / np.linalg.norm(centroids, axis=1, keepdims=True)
+                self.labels = labels
+        return self.labels, self.centroids
+
+    def predict(self, texts):
+        """(intent, confidence, margin) for each of texts; margin is the cosine gap to the runner-up."""
+        labels, centroids = self.fit()
+        vectors = [self.embed_query(text) for text in texts] if self.embed_query else self.embed(texts)
+        similarities = np.asarray(vectors, dtype="float32") @ centroids.T
+        scores = np.exp((similarities - similarities.max(axis=1, keepdims=True)) / INTENT_TEMPERATURE)
+        probabilities = scores / scores.sum(axis=1, keepdims=True)
+        best = probabilities.argmax(axis=1)
+        top2 = np.sort(similarities, axis=1)[:, -2:] if len(labels) > 1 else np.zeros((len(texts), 2))
+        margins = top2[:, 1] - top2[:, 0]
+        return [(labels[i], float(probabilities[row, i]), float(margins[row])) for row, i in enumerate(best)]
+
+    def classify(self, text):
+        """Sub-queries like detect_intent_llm returns, or None when not confident."""
+        clauses = [clause.strip() for clause in CLAUSE_SPLIT.split(text) if clause and clause.strip()]
+        if not clauses or any(is_multi_request(clause) for clause in clauses):
+            return None
+        try:
+            predictions = self.predict(clauses)
+        except Exception as e:
+            print("Intent classifier error:", e)
+            return None
+
+        items = []
+        for clause, (intent, confidence, margin) in zip(clauses, predictions):
+            if confidence < self.min_confidence or margin < self.min_margin:
+                return None
+            if items and items[-1]["intent"] == intent:
+                items[-1]["query"] += " " + clause
+            else:
+                items.append({"query": clause, "intent": intent})
+        for item in items:
+            time_data = parse_time(item["query"]) if item["intent"] in TIMED_INTENTS else None
+            if time_data:
+                item["time_data"] = time_data
+        return items
@@ -0,0 +1,213 @@
+import re
+import time
+import asyncio
+import threading
+from datetime import datetime, timedelta
+
+# Rule-based fast path in front of the LLM intent classifier. Greetings, explicit
+# timers/reminders and plain math input are recognized locally; anything the rules are
+# not sure about (several requests in one message, questions about timers, ...) goes to
+# the embedding classifier (intent_classifier.py) and then to the LLM. Timer and
+# reminder matches also carry the parsed time, so the time-extraction LLM call is
+# skipped as well.
+
+GREETING = re.compile(
+    r"^(hi+|hello+|hey+|hiya|howdy|yo|greetings|good (morning|afternoon|evening)|what'?s up|sup)"
+    r"( there| buddy| study buddy| friend| everyone)?[\s!.,:;)(]*$", re.IGNORECASE)
+
+TIMER_WORDS = re.compile(r"\b(timer|alarm|remind|reminder|alert|notify|wake me)\b", re.IGNORECASE)
+REMINDER_WORDS = re.compile(r"\b(alarm|remind|reminder|alert|notify|wake me)\b", re.IGNORECASE)
+DURATION = re.compile(r"(\d+(?:\.\d+)?)\s*(hours?|hrs?|h|minutes?|mins?|m|seconds?|secs?|s)\b"
+                      r"|\b(half an?|an?)\s+(hour|minute|second)\b", re.IGNORECASE)
+ABSOLUTE = re.compile(r"\bat\s+(\d{1,2})(?::(\d{2}))?\s*(am|pm|a\.m\.|p\.m\.)?(?![\w:])", re.IGNORECASE)
+UNIT_SECONDS = {"h": 3600, "m": 60, "s": 1}
+
+MATH_VERB = re.compile(r"^(solve|simplify|calculate|compute|evaluate|factori[sz]e|factor|expand|differentiate|"
+                       r"integrate|what is|what's|find)\b", re.IGNORECASE)
+MATH_EXPRESSION = re.compile(r"\d\s*[-+*/^=×÷<>]\s*[\w(√]|[a-z)]\s*\^\s*\d|√\s*\d", re.IGNORECASE)
+MATH_ONLY = re.compile(r"^[\d\sa-z.,+\-*/^=()×÷√%<>!]+$", re.IGNORECASE)
+MULTI_REQUEST = re.compile(r"\b(and|also|then|plus)\b|[;?]", re.IGNORECASE)
+MAX_RULE_WORDS = 15
+
+
+def _duration_seconds(text):
+    seconds = 0
+    for number, unit, article, article_unit in DURATION.findall(text):
+        if number:
+            seconds += float(number) * UNIT_SECONDS[unit[0].lower()]
+        else:
+            seconds += (0.5 if article.lower().startswith("half") else 1) * UNIT_SECONDS[article_unit[0].lower()]
+    return int(seconds)
+
+
+def parse_time(text, now=None):
+    """time_data like extract_time_llm returns, or None when the time is not explicit."""
+    now = now or datetime.now()
+    absolute = ABSOLUTE.search(text)
+    relative = DURATION.search(ABSOLUTE.sub("", text))  # so the "am" in "at 6 am" is no duration
+    if relative and not absolute:
+        seconds = _duration_seconds(text)
+        if seconds <= 0:
+            return None
+        return {"type": "relative", "seconds": seconds,
+                "time": (now + timedelta(seconds=seconds)).strftime("%I:%M %p")}
+    if absolute and not relative:
+        hour, minute, meridiem = int(absolute.group(1)), int(absolute.group(2) or 0), absolute.group(3)
+        if meridiem:
+            if not 1 <= hour <= 12:
+                return None
+            hour = hour % 12 + (12 if meridiem.lower().startswith("p") else 0)
+        elif absolute.group(2) is None:
+            return None  # "at 6" could be morning or evening
+        if hour > 23 or minute > 59:
+            return None
+        return {"type": "absolute", "time": now.replace(hour=hour, minute=minute).strftime("%I:%M %p")}
+    return None
+
+
+def is_math(text):
+    if MATH_ONLY.match(text) and re.search(r"\d", text) and re.search(r"[-+*/^=×÷√]", text):
+        # Letters only as single-letter variables, e.g. 2x + 3 = 7
+        if all(len(word) == 1 for word in re.findall(r"[a-z]+", text, re.IGNORECASE)):
+            return True
+    return bool(MATH_VERB.match(text)) and bool(MATH_EXPRESSION.search(text))
+
+
+def is_multi_request(text):
+    """Whether text may hold several requests ("remind me at 6pm and explain integration").
+
+    A single trailing question mark does not count; commas do, as they often join
+    requests without a conjunction.
+    """
+    text = text.strip().rstrip("?!. ")
+    return bool(MULTI_REQUEST.search(text)) or "," in text
+
+
+def fast_intent(text):
+    """[{"query", "intent"[, "time_data"]}] when the rules are confident, otherwise None."""
+    text = text.strip()
+    if not text or len(text.split()) > MAX_RULE_WORDS:
+        return None
+    if GREETING.match(text):
+        return [{"query": text, "intent": "greeting"}]
+    if TIMER_WORDS.search(text):
+        if MULTI_REQUEST.search(text):
+            return None
+        time_data = parse_time(text)
+        if time_data is None:
+            return None
+        intent = "set_reminder" if REMINDER_WORDS.search(text) else "study_schedule"
+        return [{"query": text, "intent": intent, "time_data": time_data}]
+    if is_math(text):
+        return [{"query": text, "intent": "general_query"}]
+    return None
+
+
+class IntentStats:
+    """How often the rules or the local classifier answered, and the LLM latency avoided."""
+
+    def __init__(self):
+        self.messages = 0
+        self.fast = {}
+        self.sources = {}
+        self.local_seconds = {}
+        self.llm_calls = {}
+        self.llm_seconds = {}
+        self.time_skipped = 0
+        self._lock = threading.Lock()
+
+    def record_fast(self, source, items, seconds):
+        with self._lock:
+            self.messages += 1
+            self.sources[source] = self.sources.get(source, 0) + 1
+            self.local_seconds[source] = self.local_seconds.get(source, 0.0) + seconds
+            for item in items:
+                self.fast[item["intent"]] = self.fast.get(item["intent"], 0) + 1
+                self.time_skipped += "time_data" in item
+
+    def record_llm(self, kind, seconds, message=False):
+        with self._lock:
+            self.messages += message
+            self.llm_calls[kind] = self.llm_calls.get(kind, 0) + 1
+            self.llm_seconds[kind] = self.llm_seconds.get(kind, 0.0) + seconds
+
+    def _avg_llm(self, kind):
+        return self.llm_seconds[kind] / self.llm_calls[kind] if self.llm_calls.get(kind) else 0.0
+
+    def stats(self):
+        with self._lock:
+            fired = sum(self.sources.values())
+            saved = fired * self._avg_llm("classify") + self.time_skipped * self._avg_llm("extract_time")
+            return {
+                "messages": self.messages,
+                "fast_path": fired,
+                "fast_path_rate": fired / self.messages if self.messages else 0.0,
+                "fast_path_sources": dict(self.sources),
+                "fast_path_intents": dict(self.fast),
+                "avg_local_ms": {source: 1000 * self.local_seconds[source] / self.sources[source]
+                                 for source in self.sources},
+                "avg_llm_seconds": {kind: self._avg_llm(kind) for kind in self.llm_calls},
+                "estimated_seconds_saved": saved,
+            }
+
+
+intent_stats = IntentStats()
+
+
+def classify_intent(text, llm_classify, classifier=None):
+    """Sub-queries of text from the rules, else the local classifier, else llm_classify."""
+    started = time.perf_counter()
+    items = fast_intent(text)
+    if items is not None:
+        intent_stats.record_fast("rules", items, time.perf_counter() - started)
+        return items
+    if classifier is not None:
+        started = time.perf_counter()
+        items = classifier.classify(text)
+        if items:
+            intent_stats.record_fast("classifier", items, time.perf_counter() - started)
+            return items
+    started = time.perf_counter()
+    items = llm_classify(text)
+    intent_stats.record_llm("classify", time.perf_counter() - started, message=True)
+    return items
+
+
+def extract_time(item, llm_extract):
+    """The sub-query's time_data, parsed by the fast path or else by llm_extract."""
+    if "time_data" in item:
+        return item["time_data"]
+    started = time.perf_counter()
+    time_data = llm_extract(item["query"])
+    intent_stats.record_llm("extract_time", time.perf_counter() - started)
+    return time_data
+
+
+async def classify_intent_async(text, llm_classify, classifier=None, executor=None):
+    """classify_intent for asyncio code: llm_classify is a coroutine function, and the
+    local classifier encodes on executor so that it does not block the event loop."""
+    started = time.perf_counter()
+    items = fast_intent(text)
+    if items is not None:
+        intent_stats.record_fast("rules", items, time.perf_counter() - started)
+        return items
+    if classifier is not None:
+        started = time.perf_counter()
+        items = await asyncio.get_running_loop().run_in_executor(executor, classifier.classify, text)
+        if items:
+            intent_stats.record_fast("classifier", items, time.perf_counter() - started)
+            return items
+    started = time.perf_counter()
+    items = await llm_classify(text)
+    intent_stats.record_llm("classify", time.perf_counter() - started, message=True)
+    return items
+
+
+async def extract_time_async(item, llm_extract):
+    """extract_time with a coroutine function llm_extract."""
+    if "time_data" in item:
+        return item["time_data"]
+    started = time.perf_counter()
+    time_data = await llm_extract(item["query"])
+    intent_stats.record_llm("extract_time", time.perf_counter() - started)
+    return time_data
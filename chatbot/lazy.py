@@ -0,0 +1,21 @@
+import importlib
+
+# Deferred imports for heavy modules (faiss, cv2, PyPDF2, langchain, ...), so an app can
+# bind its port without paying for them up front. import_report.py shows what is left.
+
+
+class LazyModule:
+    """Stands in for a module and imports it on first attribute access."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+def lazy_import(name):
+    return LazyModule(name)
@@ -0,0 +1,431 @@
+import os
+import json
+import time
+import random
+import asyncio
+import threading
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from types import SimpleNamespace
+import numpy as np
+from lazy import lazy_import
+from model_routing import tier_stats
+
+groq = lazy_import("groq")
+
+# Shared gateway for every Groq call in the apps and the Telegram bot. make_client() and
+# make_async_client() return look-alikes of groq.Client / groq.AsyncGroq whose
+# chat.completions.create and audio.transcriptions.create calls
+#
+#   - wait in a per-model queue: at most `concurrency` calls in flight and, when `tpm`
+#     is set, at most that many (estimated) tokens admitted per rolling minute;
+#     waiting requesters are served round robin, each one's calls in order
+#   - are retried on 429, 5xx, timeouts and connection errors, with jittered
+#     exponential backoff (or the provider's Retry-After when it is longer)
+#   - fail fast with LLMUnavailable while the model's circuit is open: after
+#     LLM_BREAKER_FAILURES failures in a row (429s excluded) for LLM_BREAKER_COOLDOWN
+#     seconds, then a single trial call decides whether it closes again
+#   - may name their routing tier (tier=..., see model_routing.py), which is not sent
+#     to Groq but gets the call's latency and token usage recorded in tier_stats
+#
+# Per-model limits: LLM_CONCURRENCY and LLM_TPM are the defaults, LLM_LIMITS overrides
+# them per model, e.g. '{"llama-3.3-70b-versatile": {"concurrency": 8, "tpm": 6000}}'.
+
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))  # seconds per provider call
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "60"))  # longest wait for a slot
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "4"))
+LLM_TPM = int(os.getenv("LLM_TPM", "0"))  # 0: no token budget; set it to the account's tokens-per-minute limit
+LLM_LIMITS = json.loads(os.getenv("LLM_LIMITS", "{}"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+BACKOFF_BASE = 0.5  # seconds; attempt n sleeps up to BACKOFF_BASE * 2**n
+BACKOFF_CAP = 20
+COMPLETION_TOKENS = 512  # assumed answer length when a call sets no max_tokens
+IMAGE_TOKENS = 1000  # rough prompt cost of an image
+CHARS_PER_TOKEN = 4
+WAIT_WINDOW = 1000  # recent queue waits the percentiles are computed over
+
+requester = ContextVar("llm_requester", default="")
+
+
+class LLMUnavailable(Exception):
+    """The model cannot take the call now: circuit open, queue timeout or retries exhausted."""
+
+
+def set_requester(name):
+    """Queue this request's (or task's) LLM calls fairly against other requesters' calls."""
+    requester.set(str(name))
+
+
+class Waiter:
+    def __init__(self, tokens, on_grant):
+        self.requester = requester.get()
+        self.tokens = tokens
+        self.on_grant = on_grant
+        self.enqueued = time.monotonic()
+        self.entry = None
+
+
+class ModelQueue:
+    """Admission control, retry accounting and circuit breaker of one model."""
+
+    def __init__(self, model, concurrency, tpm):
+        self.model = model
+        self.concurrency = concurrency
+        self.tpm = tpm
+        self.active = 0
+        self.window = deque()  # [admitted at, tokens] of the last minute
+        self.waiting = OrderedDict()  # requester -> its waiters, in round-robin order
+        self.waits = deque(maxlen=WAIT_WINDOW)
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.rejected = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.trial = False
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def _enqueue(self, waiter):
+        with self._lock:
+            self.waiting.setdefault(waiter.requester, deque()).append(waiter)
+            self._dispatch()
+
+    def _cancel(self, waiter):
+        """Take waiter out of the queue; False when it was granted in the meantime."""
+        with self._lock:
+            waiters = self.waiting.get(waiter.requester)
+            if not waiters or waiter not in waiters:
+                return False
+            waiters.remove(waiter)
+            if not waiters:
+                del self.waiting[waiter.requester]
+            self.rejected += 1
+            return True
+
+    def _dispatch(self):
+        now = time.monotonic()
+        while self.window and now - self.window[0][0] >= 60:
+            self.window.popleft()
+        while self.waiting and self.active < self.concurrency:
+            requester_name, waiters = next(iter(self.waiting.items()))
+            waiter = waiters[0]
+            delay = self._budget_delay(waiter.tokens, now)
+            if delay > 0:
+                if self._timer is None:
+                    self._timer = threading.Timer(delay, self._wake)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+            waiters.popleft()
+            del self.waiting[requester_name]
+            if waiters:
+                self.waiting[requester_name] = waiters  # back of the round
+            self.active += 1
+            self.requests += 1
+            waiter.entry = [now, waiter.tokens]
+            self.window.append(waiter.entry)
+            self.waits.append(now - waiter.enqueued)
+            waiter.on_grant()
+
+    def _wake(self):
+        with self._lock:
+            self._timer = None
+            self._dispatch()
+
+    def _budget_delay(self, tokens, now):
+        """Seconds until tokens fit the rolling-minute budget."""
+        if not self.tpm:
+            return 0.0
+        used = sum(entry[1] for entry in self.window)
+        if not used or used + tokens <= self.tpm:
+            return 0.0  # a call larger than the whole budget still goes alone
+        for admitted, spent in self.window:
+            used -= spent
+            if used + tokens <= self.tpm:
+                return admitted + 60 - now
+        return self.window[-1][0] + 60 - now
+
+    def acquire(self, tokens, timeout=LLM_QUEUE_TIMEOUT):
+        granted = threading.Event()
+        waiter = Waiter(tokens, granted.set)
+        self._enqueue(waiter)
+        if not granted.wait(timeout) and self._cancel(waiter):
+            raise LLMUnavailable(f"{self.model}: no capacity within {timeout:.0f}s")
+        return waiter
+
+    async def acquire_async(self, tokens, timeout=LLM_QUEUE_TIMEOUT):
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+        waiter = Waiter(tokens, lambda: loop.call_soon_threadsafe(
+            lambda: granted.done() or granted.set_result(None)))
+        self._enqueue(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(granted), timeout)
+        except asyncio.TimeoutError:
+            if self._cancel(waiter):
+                raise LLMUnavailable(f"{self.model}: no capacity within {timeout:.0f}s")
+        except asyncio.CancelledError:
+            if not self._cancel(waiter):
+                self.release(waiter)
+            raise
+        return waiter
+
+    def release(self, waiter, tokens=None):
+        """Free waiter's slot; tokens, when known, replaces its estimate in the budget."""
+        with self._lock:
+            self.active -= 1
+            if tokens is not None:
+                waiter.entry[1] = tokens
+            self._dispatch()
+
+    def check_circuit(self):
+        """Raise LLMUnavailable while the circuit is open; True when this call is the trial."""
+        with self._lock:
+            if not self.open_until:
+                return False
+            if time.monotonic() < self.open_until or self.trial:
+                self.rejected += 1
+                raise LLMUnavailable(f"{self.model}: circuit open after repeated failures")
+            self.trial = True  # cooldown over; this call decides
+            return True
+
+    def end_trial(self, trial):
+        """Give up the trial of a call that ended before reaching the model."""
+        if trial:
+            with self._lock:
+                self.trial = False
+
+    def record_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.open_until = 0.0
+            self.trial = False
+
+    def record_failure(self, counts):
+        with self._lock:
+            self.failures += 1
+            if counts:
+                self.consecutive_failures += 1
+                if self.trial or self.consecutive_failures >= LLM_BREAKER_FAILURES:
+                    self.open_until = time.monotonic() + LLM_BREAKER_COOLDOWN
+            self.trial = False
+
+    def stats(self):
+        with self._lock:
+            waits = np.array(self.waits)
+            now = time.monotonic()
+            return {
+                "active": self.active,
+                "concurrency": self.concurrency,
+                "queue_depth": sum(len(waiters) for waiters in self.waiting.values()),
+                "tokens_last_minute": sum(entry[1] for entry in self.window if now - entry[0] < 60),
+                "tpm": self.tpm,
+                "requests": self.requests,
+                "retries": self.retries,
+                "failures": self.failures,
+                "rejected": self.rejected,
+                "circuit": "open" if self.open_until > now else "half-open" if self.open_until else "closed",
+                "wait_p50_seconds": float(np.percentile(waits, 50)) if len(waits) else 0.0,
+                "wait_p95_seconds": float(np.percentile(waits, 95)) if len(waits) else 0.0,
+            }
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def model_queue(model):
+    with _queues_lock:
+        if model not in _queues:
+            limits = LLM_LIMITS.get(model, {})
+            _queues[model] = ModelQueue(model, int(limits.get("concurrency", LLM_CONCURRENCY)),
+                                        int(limits.get("tpm", LLM_TPM)))
+        return _queues[model]
+
+
+def gateway_stats():
+    with _queues_lock:
+        queues = list(_queues.values())
+    return {queue.model: queue.stats() for queue in queues}
+
+
+def estimate_tokens(kind, kwargs):
+    if kind != "chat":
+        return 0  # transcriptions are limited by concurrency only
+    chars = 0
+    for message in kwargs.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            chars += len(content)
+        elif isinstance(content, list):
+            for part in content:
+                is_text = part.get("type") == "text"
+                chars += len(part.get("text", "")) if is_text else IMAGE_TOKENS * CHARS_PER_TOKEN
+    return chars // CHARS_PER_TOKEN + kwargs.get("max_tokens", COMPLETION_TOKENS)
+
+
+def finish(queue, waiter, tier, started, usage):
+    """Release a successful call's slot and record it for its tier."""
+    queue.release(waiter, getattr(usage, "total_tokens", None))
+    if tier:
+        tier_stats.record(tier, time.perf_counter() - started, usage)
+
+
+def classify_error(error):
+    """(retry it, count it towards opening the circuit)"""
+    status = getattr(error, "status_code", None)
+    if status == 429:
+        return True, False
+    if isinstance(error, groq.APIConnectionError):  # includes timeouts
+        return True, True
+    if status is not None and (status >= 500 or status == 408):
+        return True, True
+    return False, False
+
+
+def backoff_seconds(attempt, error):
+    delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))  # full jitter
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return max(delay, float(headers.get("retry-after", 0)))
+    except ValueError:
+        return delay
+
+
+def _held_stream(queue, waiter, tier, started, stream):
+    # A streamed completion keeps its slot until the last chunk has been read; Groq
+    # reports the usage with the final chunk
+    usage = None
+    try:
+        for chunk in stream:
+            usage = getattr(getattr(chunk, "x_groq", None), "usage", None) or usage
+            yield chunk
+    finally:
+        finish(queue, waiter, tier, started, usage)
+
+
+class _Endpoint:
+    def __init__(self, gateway, kind):
+        self.gateway = gateway
+        self.kind = kind
+
+    def create(self, **kwargs):
+        return self.gateway.call(self.kind, kwargs)
+
+
+class _AsyncEndpoint(_Endpoint):
+    async def create(self, **kwargs):
+        return await self.gateway.call(self.kind, kwargs)
+
+
+class GatewayClient:
+    """groq.Client look-alike whose calls go through the gateway's model queues."""
+
+    endpoint = _Endpoint
+
+    def __init__(self, api_key):
+        self.api_key = api_key
+        self.chat = SimpleNamespace(completions=self.endpoint(self, "chat"))
+        self.audio = SimpleNamespace(transcriptions=self.endpoint(self, "audio"))
+        self._client = None
+
+    def _create(self, kind):
+        if self._client is None:
+            # Retries are the gateway's job
+            self._client = self._make_client()
+        return self._client.chat.completions.create if kind == "chat" else self._client.audio.transcriptions.create
+
+    def _make_client(self):
+        return groq.Client(api_key=self.api_key, timeout=LLM_TIMEOUT, max_retries=0)
+
+    def call(self, kind, kwargs):
+        tier = kwargs.pop("tier", None)
+        queue = model_queue(kwargs.get("model"))
+        tokens = estimate_tokens(kind, kwargs)
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            trial = queue.check_circuit()
+            try:
+                waiter = queue.acquire(tokens)
+            except BaseException:
+                queue.end_trial(trial)
+                raise
+            started = time.perf_counter()
+            try:
+                response = self._create(kind)(**kwargs)
+            except Exception as e:
+                queue.release(waiter, 0)  # a failed call used no tokens
+                retry, counts = classify_error(e)
+                queue.record_failure(counts)
+                if not retry:
+                    raise
+                if attempt == LLM_MAX_RETRIES:
+                    raise LLMUnavailable(f"{queue.model}: {e}") from e
+                queue.record_retry()
+                time.sleep(backoff_seconds(attempt, e))
+                continue
+            except BaseException:
+                queue.release(waiter, 0)  # interrupted or cancelled; the call's outcome is unknown
+                queue.end_trial(trial)
+                raise
+            queue.record_success()
+            if kwargs.get("stream"):
+                return _held_stream(queue, waiter, tier, started, response)
+            finish(queue, waiter, tier, started, getattr(response, "usage", None))
+            return response
+
+
+class AsyncGatewayClient(GatewayClient):
+    """groq.AsyncGroq look-alike; create() is awaited."""
+
+    endpoint = _AsyncEndpoint
+
+    def _make_client(self):
+        return groq.AsyncGroq(api_key=self.api_key, timeout=LLM_TIMEOUT, max_retries=0)
+
+    async def call(self, kind, kwargs):
+        tier = kwargs.pop("tier", None)
+        queue = model_queue(kwargs.get("model"))
+        tokens = estimate_tokens(kind, kwargs)
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            trial = queue.check_circuit()
+            try:
+                waiter = await queue.acquire_async(tokens)
+            except BaseException:
+                queue.end_trial(trial)
+                raise
+            started = time.perf_counter()
+            try:
+                response = await self._create(kind)(**kwargs)
+            except Exception as e:
+                queue.release(waiter, 0)  # a failed call used no tokens
+                retry, counts = classify_error(e)
+                queue.record_failure(counts)
+                if not retry:
+                    raise
+                if attempt == LLM_MAX_RETRIES:
+                    raise LLMUnavailable(f"{queue.model}: {e}") from e
+                queue.record_retry()
+                await asyncio.sleep(backoff_seconds(attempt, e))
+                continue
+            except BaseException:
+                queue.release(waiter, 0)  # interrupted or cancelled; the call's outcome is unknown
+                queue.end_trial(trial)
+                raise
+            queue.record_success()
+            finish(queue, waiter, tier, started, getattr(response, "usage", None))
+            return response
+
+
+def make_client(api_key):
+    return GatewayClient(api_key)
+
+
+def make_async_client(api_key):
+    return AsyncGatewayClient(api_key)
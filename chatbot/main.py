@@ -1,28 +1,39 @@
+import time
+STARTED = time.perf_counter()  # startup timings are reported by /ready
 import json
-from flask import Flask, request, jsonify, render_template, session
+from flask import Flask, request, jsonify, render_template, copy_current_request_context
 from flask_cors import CORS, cross_origin
 from flask_socketio import SocketIO
-import groq
-import re
 import threading
 from datetime import datetime, timedelta
 import os
-from twilio.rest import Client as TwilioClient
+import hashlib
+import uuid
+import contextvars
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, wait
 from dotenv import load_dotenv
 import base64
-from PyPDF2 import PdfReader
-import docx
-import faiss
-import numpy as np
-from sentence_transformers import SentenceTransformer
-from langchain_community.chat_message_histories import ChatMessageHistory
-from langchain_core.messages import HumanMessage, AIMessage
-import cv2
 import numpy as np
+from ingest_jobs import IngestQueue
+from retrieval_client import RetrievalClient
+from intent_classifier import IntentClassifier
+from intent_rules import classify_intent, extract_time, intent_stats
+from response_cache import SemanticResponseCache, is_context_dependent
+from streaming import ResponseCleaner, StreamStats, strip_markdown
+from lazy import lazy_import
+from llm_gateway import LLMUnavailable, gateway_stats, make_client, set_requester
+from model_routing import route, tier_stats
 load_dotenv()
 
+# Heavy modules are imported on first use, so the port binds without them
+# (python import_report.py main shows what startup still imports)
+cv2 = lazy_import("cv2")
+twilio_rest = lazy_import("twilio.rest")
+chat_histories = lazy_import("langchain_community.chat_message_histories")
+lc_messages = lazy_import("langchain_core.messages")
+
 from pymongo import MongoClient 
-from bson.objectid import ObjectId
 
 # MongoDB Setup
 mongo_uri = os.getenv("MONGO_URI")
@@ -58,25 +69,72 @@ def handle_options():
         response.headers.add("Access-Control-Allow-Methods", "GET,PUT,POST,DELETE,OPTIONS")
         response.headers.add("Access-Control-Allow-Credentials", "true")
         return response
-socketio = SocketIO(app, cors_allowed_origins="*")
+# Threading mode: answers are streamed from the request thread, which eventlet would
+# block without monkey-patching
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode="threading")
 
 groq_api_key = os.getenv("GROQ_API_KEY")
-client = groq.Client(api_key=groq_api_key) 
+# Every Groq call goes through the gateway's per-model queues, retries and circuit
+# breakers (see llm_gateway.py)
+client = make_client(groq_api_key)
+
+# Document embedding and retrieval: the shared service when EMBED_SERVICE_URL is set,
+# otherwise an in-process encoder and persistent index (see retrieval_client.py).
+# The encoder is warmed up in the background once the server starts; see /ready and
+# start_warm_up below.
+retrieval = RetrievalClient("main")
+
+# Intents are classified by rules, then by the encoder above, then by the LLM
+intent_classifier = IntentClassifier(retrieval.embed, embed_query=retrieval.embed_query)
+
+# Loaded in the background once per serving process: from __main__, or on the first
+# request when a server such as gunicorn imports the app instead
+warm_up_lock = threading.Lock()
+warm_up_started = False
+
+def start_warm_up():
+    global warm_up_started
+    with warm_up_lock:
+        if warm_up_started:
+            return
+        warm_up_started = True
+    retrieval.start_warm_up()
+    threading.Thread(target=intent_classifier.fit, daemon=True).start()
 
-embedding_model = SentenceTransformer("all-MiniLM-L6-v2")
+@app.before_request
+def warm_up_on_first_request():
+    start_warm_up()
 
-# Global index and mapping
-index = faiss.IndexFlatL2(384)  # For all-MiniLM-L6-v2
-id_to_text = {}
-next_id = 0 
+# Answers to standalone general questions, shared by students with the same profile
+response_cache = SemanticResponseCache()
 
 # Session storage for conversation histories
 session_histories = {}
+history_lock = threading.RLock()
+
+def get_session_history(session_id: str):
+    with history_lock:
+        if session_id not in session_histories:
+            session_histories[session_id] = chat_histories.ChatMessageHistory()
+        return session_histories[session_id]
+
+def record_exchange(session_id, query, answer, exchanges=None):
+    """Add a question and its answer to the session history as one pair.
 
-def get_session_history(session_id: str) -> ChatMessageHistory:
-    if session_id not in session_histories:
-        session_histories[session_id] = ChatMessageHistory()
-    return session_histories[session_id]
+    With an exchanges list the pair is collected there instead, so that /chat can add
+    the answers to a multi-part message in the message's order.
+    """
+    if exchanges is not None:
+        exchanges.append((query, answer))
+        return
+    with history_lock:
+        history = get_session_history(session_id)
+        history.add_user_message(query)
+        history.add_ai_message(answer)
+
+# Sub-queries of one message are answered in parallel on this pool
+SUBQUERY_WORKERS = int(os.getenv("SUBQUERY_WORKERS", "4"))
+subquery_executor = ThreadPoolExecutor(max_workers=SUBQUERY_WORKERS)
 
 def detect_intent_llm(text):
     prompt = [
@@ -105,7 +163,7 @@ def detect_intent_llm(text):
     ]
 
     response = client.chat.completions.create(
-        model="llama3-70b-8192",
+        **route("classify"),
         response_format={"type": "json_object"},
         messages=prompt
     )
@@ -144,7 +202,7 @@ def extract_time_llm(text):
     ]
 
     response = client.chat.completions.create(
-        model="llama3-70b-8192",
+        **route("extract_time"),
         messages=prompt
     )
 
@@ -160,10 +218,16 @@ twilio_token = os.getenv("TWILIO_TOKEN")
 twilio_number = os.getenv("TWILIO_NUMBER")
 user_phone_number = os.getenv("USER_PHONE_NUMBER")
 
-twilio_client = TwilioClient(twilio_sid, twilio_token)
+twilio_client = None
+
+def get_twilio_client():
+    global twilio_client
+    if twilio_client is None:
+        twilio_client = twilio_rest.Client(twilio_sid, twilio_token)
+    return twilio_client
 
 def send_sms(message):
-    twilio_client.messages.create(
+    get_twilio_client().messages.create(
         body=message,
         from_=twilio_number,
         to=user_phone_number
@@ -171,23 +235,58 @@ def send_sms(message):
 
 def make_call(message):
     twiml = f'<Response><Say>{message}</Say></Response>'
-    call = twilio_client.calls.create(
+    call = get_twilio_client().calls.create(
         twiml=twiml,
         to=user_phone_number,
         from_=twilio_number
     )
 
 def clean_response(text):
-    # Remove asterisk-based markdown (e.g., *text*, **text**)
-    text = re.sub(r'\*\*(.*?)\*\*', r'\1', text)
-    text = re.sub(r'\*(.*?)\*', r'\1', text)
-    return text.strip()
+    return strip_markdown(text).strip()
+
+stream_stats = StreamStats()
+
+def stream_target(sid):
+    """The Socket.IO session id a client asked to be sent to, if it is connected."""
+    if isinstance(sid, str) and sid and socketio.server.manager.is_connected(sid, "/"):
+        return sid
+    return None
+
+def stream_completion(messages, room, markdown=True, task="general_query", level=None):
+    """Generate an answer, sending it to the Socket.IO room as it arrives; return the full text.
+
+    room is the client's Socket.IO session id (see stream_target). It gets answer_start, answer_token (cleaned text so far, in pieces) and
+    answer_end with the whole answer, all tagged with the same stream_id.
+    """
+    stream_id = uuid.uuid4().hex
+    socketio.emit("answer_start", {"stream_id": stream_id}, to=room)
+    cleaner = ResponseCleaner(markdown)
+    parts = []
+    started = time.perf_counter()
+    first_token = None
+    for chunk in client.chat.completions.create(**route(task, level), messages=messages, stream=True):
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if not delta:
+            continue
+        if first_token is None:
+            first_token = time.perf_counter() - started
+        text = cleaner.feed(delta)
+        if text:
+            parts.append(text)
+            socketio.emit("answer_token", {"stream_id": stream_id, "text": text}, to=room)
+    parts.append(cleaner.finish())
+    stream_stats.record(first_token, time.perf_counter() - started)
+
+    answer = "".join(parts)
+    socketio.emit("answer_end", {"stream_id": stream_id, "text": answer}, to=room)
+    return answer
 
 def start_timer(seconds):
     socketio.emit("start_timer", {"seconds": seconds})  # Send initial time
     threading.Timer(seconds, lambda: socketio.emit("timer_finished", {"message": "✅ Timer finished! Take a short break! ☕"})).start()
 
-def generate_response_with_history(query, session_id, username):
+def generate_response_with_history(query, session_id, username, cacheable=False, stream_to=None, exchanges=None,
+                                   intent="general_query"):
     # Get the conversation history
     history = get_session_history(session_id)
     
@@ -212,6 +311,22 @@ def generate_response_with_history(query, session_id, username):
     else:
         education_context = "User's education details are not available."
         print(f"No education details found for username: {username}") 
+
+    # Standalone questions are answered from the semantic cache when a student with the
+    # same level and course asked something close enough
+    profile = (user_education.get('educationLevel', 'Not specified') if user_education else 'Not specified',
+               user_education.get('course', 'Not specified') if user_education else 'Not specified')
+    embedding = None
+    if cacheable and response_cache.enabled:
+        if is_context_dependent(query, history.messages):
+            response_cache.bypass()
+        else:
+            embedding = retrieval.embed_query(query)  # cached when classified or retrieved first
+            cached = response_cache.get(profile, embedding)
+            if cached is not None:
+                record_exchange(session_id, query, cached, exchanges)
+                return cached
+
     # Prepare the messages for the LLM with education context
     messages = [
         {
@@ -237,30 +352,35 @@ def generate_response_with_history(query, session_id, username):
     
     # Add the last 5 messages from history (adjust as needed)
     for msg in history.messages[-10:]:  # Keep last 10 messages for context
-        if isinstance(msg, HumanMessage):
+        if isinstance(msg, lc_messages.HumanMessage):
             messages.append({"role": "user", "content": msg.content})
-        elif isinstance(msg, AIMessage):
+        elif isinstance(msg, lc_messages.AIMessage):
             messages.append({"role": "assistant", "content": msg.content})
     
     # Add the current query
     messages.append({"role": "user", "content": query})
     
     # Generate response
-    response = client.chat.completions.create(
-        model="llama-3.3-70b-versatile", 
-        messages=messages
-    )
-    
-    raw_response = response.choices[0].message.content
-    clean_response_text = clean_response(raw_response)
+    started = time.perf_counter()
+    if stream_to:
+        clean_response_text = stream_completion(messages, stream_to, task=intent, level=profile[0])
+    else:
+        response = client.chat.completions.create(
+            **route(intent, profile[0]),
+            messages=messages
+        )
+        
+        raw_response = response.choices[0].message.content
+        clean_response_text = clean_response(raw_response)
+    if embedding is not None:
+        response_cache.put(profile, embedding, clean_response_text, time.perf_counter() - started)
     
     # Update history
-    history.add_user_message(query)
-    history.add_ai_message(clean_response_text)
+    record_exchange(session_id, query, clean_response_text, exchanges)
     
     return clean_response_text
 
-def generate_greeting_response(user_input, session_id):
+def generate_greeting_response(user_input, session_id, exchanges=None):
     history = get_session_history(session_id)
     
     messages = [
@@ -268,23 +388,22 @@ def generate_greeting_response(user_input, session_id):
     ]
     
     for msg in history.messages[-5:]:
-        if isinstance(msg, HumanMessage):
+        if isinstance(msg, lc_messages.HumanMessage):
             messages.append({"role": "user", "content": msg.content})
-        elif isinstance(msg, AIMessage):
+        elif isinstance(msg, lc_messages.AIMessage):
             messages.append({"role": "assistant", "content": msg.content})
     
     messages.append({"role": "user", "content": user_input})
     
     response = client.chat.completions.create(
-        model="llama-3.3-70b-versatile",
+        **route("greeting"),
         messages=messages
     )
     
     raw_response = response.choices[0].message.content
     clean_response_text = clean_response(raw_response)
     
-    history.add_user_message(user_input)
-    history.add_ai_message(clean_response_text)
+    record_exchange(session_id, user_input, clean_response_text, exchanges)
     
     return clean_response_text
 
@@ -292,7 +411,7 @@ def transcribe_audio_to_text(audio_path):
     with open(audio_path, "rb") as file:
         transcription = client.audio.transcriptions.create(
             file=(audio_path, file.read()),
-            model="whisper-large-v3-turbo",
+            **route("transcribe"),
             response_format="verbose_json",
             language="en"
         )
@@ -313,7 +432,7 @@ def handle_image_query(image_file, query=None):
     chat_prompt = query if query else "Describe this image in a very few lines.Dont provide extra context strictly follow this."
 
     response = client.chat.completions.create(
-        model="llama-3.2-11b-vision-preview",
+        **route("image"),
         messages=[
             {
                 "role": "user",
@@ -329,31 +448,35 @@ def handle_image_query(image_file, query=None):
 def is_image(file):
     return file.mimetype.startswith('image/')
 
-def extract_text(file):
-    ext = file.filename.lower()
-    if ext.endswith(".pdf"):
-        reader = PdfReader(file)
-        return "\n".join(page.extract_text() for page in reader.pages if page.extract_text())
-    elif ext.endswith(".docx"):
-        doc = docx.Document(file)
-        return "\n".join([para.text for para in doc.paragraphs])
-    elif ext.endswith(".txt"):
-        return file.read().decode("utf-8")
-    else:
-        raise ValueError("Unsupported file type")
-    
-def store_file_and_index(file):
-    global next_id
-    text = extract_text(file)
-    chunks = [text[i:i+500] for i in range(0, len(text), 500)]
-
-    for chunk in chunks:
-        embedding = embedding_model.encode(chunk, normalize_embeddings=True).astype("float32")
-        index.add(np.array([embedding]))
-        id_to_text[next_id] = chunk
-        next_id += 1
-
-def generate_llama_response_with_context(query, context, session_id):
+def store_file_and_index(path, filename, namespace="", progress=None):
+    return retrieval.index_file(path, filename, namespace, progress)
+
+# Socket.IO session id of the uploader of each job that asked for progress updates
+ingest_listeners = {}
+
+def emit_ingest_update(job):
+    sid = ingest_listeners.get(job["job_id"])
+    if sid:
+        socketio.emit("ingest_progress", job, to=sid)
+    if job["status"] in ("done", "duplicate", "failed"):
+        ingest_listeners.pop(job["job_id"], None)
+
+ingest_queue = IngestQueue(store_file_and_index, on_update=emit_ingest_update)
+INGEST_WAIT_SECONDS = float(os.getenv("INGEST_WAIT_SECONDS", "5"))
+
+def submit_document(file, namespace, notify=None):
+    """Save an uploaded document to a temp file and queue it for background indexing.
+
+    notify is a Socket.IO session id that gets the job's ingest_progress events.
+    """
+    with tempfile.NamedTemporaryFile(suffix=os.path.basename(file.filename), delete=False) as tmp:
+        file.save(tmp)
+    job_id = ingest_queue.submit(tmp.name, file.filename, namespace)
+    if notify:
+        ingest_listeners[job_id] = notify
+    return job_id
+
+def generate_llama_response_with_context(query, context, session_id, stream_to=None, exchanges=None):
     history = get_session_history(session_id)
     
     # Get username from localStorage (passed via template)
@@ -399,30 +522,79 @@ def generate_llama_response_with_context(query, context, session_id):
     ]
     
     for msg in history.messages[-5:]:
-        if isinstance(msg, HumanMessage):
+        if isinstance(msg, lc_messages.HumanMessage):
             messages.append({"role": "user", "content": msg.content})
-        elif isinstance(msg, AIMessage):
+        elif isinstance(msg, lc_messages.AIMessage):
             messages.append({"role": "assistant", "content": msg.content})
     
     messages.append({"role": "user", "content": final_prompt})
     
-    response = client.chat.completions.create(
-        model="llama-3.3-70b-versatile",
-        messages=messages
-    )
-    
-    raw_response = response.choices[0].message.content.strip()
+    level = user_education.get('educationLevel') if user_education else None
+    if stream_to:
+        raw_response = stream_completion(messages, stream_to, markdown=False, task="document_query", level=level)
+    else:
+        response = client.chat.completions.create(
+            **route("document_query", level),
+            messages=messages
+        )
+        
+        raw_response = response.choices[0].message.content.strip()
     
-    history.add_user_message(query)
-    history.add_ai_message(raw_response)
+    record_exchange(session_id, query, raw_response, exchanges)
     
     return raw_response
 
-def retrieve_relevant_text(query, top_k=5):
-    query_embedding = embedding_model.encode(query, normalize_embeddings=True).reshape(1, -1).astype("float32")
-    distances, indices = index.search(query_embedding, top_k)
-    retrieved = [id_to_text.get(i, "") for i in indices[0] if i >= 0]
-    return "\n".join(retrieved) if retrieved else "No relevant context found."
+def answer_sub_query(item, session_id, username, stream_to=None, exchanges=None):
+    """The response to one sub-query of a /chat message, or None."""
+    query = item["query"]
+    intent = item["intent"]
+    print(f"Processing intent '{intent}' for query: {query}")
+
+    if intent == "greeting":
+        return generate_greeting_response(query, session_id, exchanges)
+
+    elif intent in ["study_schedule", "set_reminder"]:
+        time_data = extract_time(item, extract_time_llm)
+        print("Time LLM Output:", time_data)
+
+        if time_data:
+            scheduled_info = f"your scheduled session at {time_data['time']}"
+
+            if time_data["type"] == "relative":
+                threading.Thread(target=start_timer, args=(time_data["seconds"],)).start()
+                return f"✅ Timer started! Your study session is set for {time_data['seconds']} seconds. Time to focus! 📚"
+
+            elif time_data["type"] == "absolute":
+                def alarm_trigger():
+                    send_sms(f"Hi! 📅 It's time for {scheduled_info}. Stay sharp! 💪")
+                    make_call(f"This is your study assistant calling. It's time for {scheduled_info}. Let's get started!")
+
+                now = datetime.now()
+                target_time = datetime.strptime(time_data["time"], "%I:%M %p")
+                target_time = target_time.replace(year=now.year, month=now.month, day=now.day)
+
+                if target_time < now:
+                    target_time += timedelta(days=1)
+
+                delay_seconds = (target_time - now).total_seconds()
+                threading.Timer(delay_seconds, alarm_trigger).start()
+
+                return f"⏰ Alarm set for {time_data['time']}. I'll call and message you when it's time! 📞"
+        else:
+            return "⌛ I can set up your study session, but I need a valid time. When should we start? 🕒"
+
+    elif intent == "motivation":
+        return generate_response_with_history(query, session_id, username, stream_to=stream_to,
+                                              exchanges=exchanges, intent="motivation")
+
+    else:  # general_query or fallback
+        # Answer from the user's documents only when some passage passed select_context's
+        # relevance cutoff (including ones still being indexed); otherwise answer normally
+        chunks = retrieval.select_context(query, username)
+        if chunks:
+            return generate_llama_response_with_context(query, "\n".join(chunks), session_id, stream_to, exchanges)
+        return generate_response_with_history(query, session_id, username, cacheable=True,
+                                              stream_to=stream_to, exchanges=exchanges)
 
 @app.route("/chat", methods=['POST', 'OPTIONS'])
 def chat():
@@ -449,7 +621,16 @@ def chat():
         print(f"Error in chat endpoint: {e}")
         return jsonify({"error": "Internal server error"}), 500
     # Generate or retrieve session ID
-    session_id = request.cookies.get('session_id') or str(hash(request.remote_addr))
+    # Stable across restarts: built-in hash() of a str is salted per process
+    session_id = request.cookies.get('session_id') or hashlib.sha256((request.remote_addr or "").encode("utf-8")).hexdigest()
+    set_requester(username)  # LLM calls are queued fairly between users
+
+    # With "stream": <the client's socket.id>, long answers are also sent token by token
+    # to that Socket.IO connection, and upload progress goes there too
+    if request.form:
+        stream_to = stream_target(request.form.get("stream"))
+    else:
+        stream_to = stream_target((request.get_json(silent=True) or {}).get("stream"))
     
     transcribed = None
     file = request.files.get("file")
@@ -461,19 +642,33 @@ def chat():
             try:
                 response_text = handle_image_query(file, query)
                 return jsonify({"response": response_text})
+            except LLMUnavailable:
+                raise  # answered with a 503 by llm_unavailable
             except Exception as e:
                 print("Image handling error:", e)
                 return jsonify({"response": "❌ Failed to process the image."}), 500
 
         elif any(file.filename.lower().endswith(ext) for ext in [".txt", ".pdf", ".docx"]):
             try:
-                store_file_and_index(file)
+                job_id = submit_document(file, username, notify=stream_to)
                 if query:
-                    context = retrieve_relevant_text(query)
-                    response_text = generate_llama_response_with_context(query, context, session_id)
-                    return jsonify({"response": response_text})
+                    # Answer from whatever has been indexed after a short wait
+                    ingest_queue.wait(job_id, INGEST_WAIT_SECONDS)
+                    chunks = retrieval.select_context(query, username)
+                    if chunks:
+                        response_text = generate_llama_response_with_context(query, "\n".join(chunks), session_id,
+                                                                             stream_to)
+                    else:
+                        response_text = generate_response_with_history(query, session_id, username, cacheable=True,
+                                                                       stream_to=stream_to)
+                    return jsonify({"response": response_text, "job_id": job_id, "streamed": bool(stream_to)})
                 else:
-                    return jsonify({"response": "📁 File processed. Ask your question related to the content."})
+                    return jsonify({
+                        "response": "📁 File received and is being indexed. You can already ask questions about it.",
+                        "job_id": job_id
+                    })
+            except LLMUnavailable:
+                raise  # answered with a 503 by llm_unavailable
             except Exception as e:
                 print("Document handling error:", e)
                 return jsonify({"response": "❌ Failed to process the document."}), 500
@@ -501,58 +696,30 @@ def chat():
         })
 
     # Intent Detection and Execution
-    sub_queries = detect_intent_llm(user_input)
+    sub_queries = classify_intent(user_input, detect_intent_llm, intent_classifier)  # LLM only when unsure
     print("Detected sub-queries:", sub_queries)
 
-    responses = []
-
-    for item in sub_queries:
-        query = item["query"]
-        intent = item["intent"]
-        print(f"Processing intent '{intent}' for query: {query}")
-
-        if intent == "greeting":
-            responses.append(generate_greeting_response(query, session_id))
-
-        elif intent in ["study_schedule", "set_reminder"]:
-            time_data = extract_time_llm(query)
-            print("Time LLM Output:", time_data)
-
-            if time_data:
-                scheduled_info = f"your scheduled session at {time_data['time']}"
-
-                if time_data["type"] == "relative":
-                    threading.Thread(target=start_timer, args=(time_data["seconds"],)).start()
-                    responses.append(f"✅ Timer started! Your study session is set for {time_data['seconds']} seconds. Time to focus! 📚")
-
-                elif time_data["type"] == "absolute":
-                    def alarm_trigger():
-                        send_sms(f"Hi! 📅 It's time for {scheduled_info}. Stay sharp! 💪")
-                        make_call(f"This is your study assistant calling. It's time for {scheduled_info}. Let's get started!")
-
-                    now = datetime.now()
-                    target_time = datetime.strptime(time_data["time"], "%I:%M %p")
-                    target_time = target_time.replace(year=now.year, month=now.month, day=now.day)
-
-                    if target_time < now:
-                        target_time += timedelta(days=1)
-
-                    delay_seconds = (target_time - now).total_seconds()
-                    threading.Timer(delay_seconds, alarm_trigger).start()
-
-                    responses.append(f"⏰ Alarm set for {time_data['time']}. I'll call and message you when it's time! 📞")
-            else:
-                responses.append("⌛ I can set up your study session, but I need a valid time. When should we start? 🕒")
-
-        elif intent == "motivation":
-            responses.append(generate_response_with_history(query, session_id,username))
-
-        else:  # general_query or fallback
-            responses.append(generate_response_with_history(query, session_id,username))
+    # Independent sub-queries are answered concurrently; the responses, and the history
+    # entries they produce, keep the order of the message
+    if len(sub_queries) == 1:
+        responses = [answer_sub_query(sub_queries[0], session_id, username, stream_to)]
+    else:
+        exchanges = [[] for _ in sub_queries]
+        futures = [subquery_executor.submit(contextvars.copy_context().run,
+                                            copy_current_request_context(answer_sub_query),
+                                            item, session_id, username, stream_to, pairs)
+                   for item, pairs in zip(sub_queries, exchanges)]
+        wait(futures)
+        for pairs in exchanges:
+            for query, answer in pairs:
+                record_exchange(session_id, query, answer)
+        responses = [future.result() for future in futures]
+    responses = [response for response in responses if response]
 
     return jsonify({
         "response": "\n\n".join(responses),
-        "transcribed": transcribed
+        "transcribed": transcribed,
+        "streamed": bool(stream_to)
     })
 
 
@@ -577,7 +744,7 @@ def extract_text_from_image(image):
         base64_image = base64.b64encode(buffer).decode("utf-8")
 
         completion = client.chat.completions.create(
-            model="llama-3.2-11b-vision-preview",
+            **route("image"),
             messages=[
                 {
                     "role": "user",
@@ -610,6 +777,8 @@ def extract_text_from_image(image):
 
         result = completion.choices[0].message.content.strip()
         return result
+    except LLMUnavailable:
+        raise
     except Exception as e:
         print(f"Error extracting/solving math problem: {e}")
         return None
@@ -645,6 +814,8 @@ def extract_text():
             return jsonify({"text": result_text})
         else:
             return jsonify({"error": "No response from the model"}), 500
+    except LLMUnavailable:
+        raise  # answered with a 503 by llm_unavailable
     except Exception as e:
         print(f"Server error: {e}")
         return jsonify({"error": "Failed to process image"}), 500
@@ -668,9 +839,66 @@ def get_solutions():
         print(f"Error fetching solutions: {e}")
         return jsonify({"error": "Failed to fetch solutions"}), 500
 
+@app.route("/ingest/<job_id>", methods=["GET"])
+def ingest_status(job_id):
+    """Report the progress of a background document ingestion job."""
+    job = ingest_queue.status(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job id"}), 404
+    return jsonify(job)
+
+@app.route("/documents", methods=["GET"])
+def list_documents():
+    """List the documents indexed for a user."""
+    username = request.args.get("username", "default").strip()
+    return jsonify({"documents": retrieval.list_documents(username)})
+
+@app.route("/documents/<doc_hash>", methods=["DELETE"])
+def delete_document(doc_hash):
+    """Remove one of a user's documents from retrieval."""
+    username = request.args.get("username", "default").strip()
+    removed = retrieval.delete_document(doc_hash, username)
+    if removed is None:
+        return jsonify({"error": "Unknown document"}), 404
+    return jsonify({"deleted": doc_hash, "chunks_removed": removed})
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Expose in-process cache, retrieval, intent fast-path, LLM gateway and model tier counters."""
+    return jsonify({
+        "retrieval": retrieval.stats(),
+        "intent": intent_stats.stats(),
+        "response_cache": response_cache.stats(),
+        "streaming": stream_stats.stats(),
+        "llm_gateway": gateway_stats(),
+        "model_tiers": tier_stats.stats()
+    })
+
+@app.errorhandler(LLMUnavailable)
+def llm_unavailable(e):
+    """The LLM is rate limited or failing: answer quickly instead of with a 500."""
+    print(f"LLM unavailable: {e}")
+    return jsonify({"response": "⏳ The study buddy is busy right now. Please try again in a moment."}), 503
+
+@app.route("/ready", methods=["GET"])
+def ready():
+    """Readiness probe: 503 until the embedding model has been warmed up."""
+    status = {
+        "ready": retrieval.ready,
+        "import_seconds": round(IMPORT_SECONDS, 3),
+        "warmup_seconds": retrieval.warmup_seconds
+    }
+    return jsonify(status), 200 if retrieval.ready else 503
+
 @app.route("/")
 def home():
     return render_template("index.html")
 
+IMPORT_SECONDS = time.perf_counter() - STARTED
+
 if __name__ == "__main__":
-    socketio.run(app, host="0.0.0.0", port=8000, debug=True)
\ No newline at end of file
+    # The debug reloader runs this file twice; only the serving child warms up
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_warm_up()
+    print(f"Imports done in {IMPORT_SECONDS:.2f}s")
+    socketio.run(app, host="0.0.0.0", port=8000, debug=True, allow_unsafe_werkzeug=True)
\ No newline at end of file
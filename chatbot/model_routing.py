@@ -0,0 +1,103 @@
+import os
+import json
+import threading
+from collections import deque
+import numpy as np
+
+# Which model answers what. Every LLM call names its task (an intent, or classify,
+# extract_time, document_query, image, transcribe) and, where known, the student's
+# education level; the routing table maps that to a tier and the tier to a model:
+#
+#   {"tiers":  {"fast": "llama-3.1-8b-instant", "large": "llama-3.3-70b-versatile", ...},
+#    "routes": {"greeting": "fast", "general_query": "large", ...},
+#    "levels": {"PG": {"general_query": "large"}, "Secondary School": {...}}}
+#
+# MODEL_ROUTING (a JSON file path or inline JSON) is merged over the defaults below, and
+# MODEL_TIER_<TIER> (e.g. MODEL_TIER_FAST) swaps the model of a single tier. The gateway
+# records latency and token usage per tier (tier_stats, shown under /metrics).
+
+DEFAULT_ROUTING = {
+    "tiers": {
+        "fast": "llama-3.1-8b-instant",
+        "large": "llama-3.3-70b-versatile",
+        "vision": "llama-3.2-11b-vision-preview",
+        "speech": "whisper-large-v3-turbo",
+    },
+    "routes": {
+        "classify": "fast",
+        "extract_time": "fast",
+        "greeting": "fast",
+        "motivation": "fast",
+        "general_query": "large",
+        "document_query": "large",
+        "image": "vision",
+        "transcribe": "speech",
+    },
+    "levels": {},
+}
+DEFAULT_TIER = "large"  # tasks missing from the routes
+TIER_STATS_WINDOW = 1000  # recent calls per tier the percentiles are computed over
+
+
+def load_routing(source=None):
+    routing = {key: dict(value) for key, value in DEFAULT_ROUTING.items()}
+    source = os.getenv("MODEL_ROUTING", "") if source is None else source
+    if source:
+        if os.path.exists(source):
+            with open(source, encoding="utf-8") as f:
+                custom = json.load(f)
+        else:
+            custom = json.loads(source)
+        for key in routing:
+            routing[key].update(custom.get(key, {}))
+    for tier in routing["tiers"]:
+        routing["tiers"][tier] = os.getenv(f"MODEL_TIER_{tier.upper()}", routing["tiers"][tier])
+    return routing
+
+
+ROUTING = load_routing()
+
+
+def route(task, level=None):
+    """{"model", "tier"} for an LLM call: pass it to the gateway client's create()."""
+    tier = ROUTING["levels"].get(level or "", {}).get(task) or ROUTING["routes"].get(task, DEFAULT_TIER)
+    return {"model": ROUTING["tiers"][tier], "tier": tier}
+
+
+class TierStats:
+    """Latency and token usage of the LLM calls of each tier."""
+
+    def __init__(self, window=TIER_STATS_WINDOW):
+        self.window = window
+        self.calls = {}
+        self.prompt_tokens = {}
+        self.completion_tokens = {}
+        self._seconds = {}
+        self._lock = threading.Lock()
+
+    def record(self, tier, seconds, usage=None):
+        with self._lock:
+            self.calls[tier] = self.calls.get(tier, 0) + 1
+            self._seconds.setdefault(tier, deque(maxlen=self.window)).append(seconds)
+            if usage is not None:
+                self.prompt_tokens[tier] = self.prompt_tokens.get(tier, 0) + (getattr(usage, "prompt_tokens", 0) or 0)
+                self.completion_tokens[tier] = (self.completion_tokens.get(tier, 0)
+                                                + (getattr(usage, "completion_tokens", 0) or 0))
+
+    def stats(self):
+        with self._lock:
+            summary = {}
+            for tier, calls in self.calls.items():
+                seconds = np.array(self._seconds[tier])
+                summary[tier] = {
+                    "model": ROUTING["tiers"].get(tier),
+                    "calls": calls,
+                    "latency_p50_seconds": float(np.percentile(seconds, 50)),
+                    "latency_p95_seconds": float(np.percentile(seconds, 95)),
+                    "prompt_tokens": self.prompt_tokens.get(tier, 0),
+                    "completion_tokens": self.completion_tokens.get(tier, 0),
+                }
+            return summary
+
+
+tier_stats = TierStats()
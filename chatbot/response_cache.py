@@ -0,0 +1,98 @@
+import os
+import re
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# Semantic cache of general_query answers. Students at the same level ask the same
+# things in different words, so a new question reuses a stored answer when its
+# embedding is close enough to the stored question's and the answer was generated for
+# the same education profile. Questions that lean on the conversation so far ("why?",
+# "explain that again") are never served from, or added to, the cache.
+
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "512"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "86400"))  # seconds an answer is reused
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.92"))  # cosine, 0 disables the cache
+
+FOLLOW_UP = re.compile(r"\b(it|its|this|that|these|those|they|them|their|he|she|above|previous|earlier|again|"
+                       r"more|another|same|else|instead|continue)\b", re.IGNORECASE)
+MIN_STANDALONE_WORDS = 4
+
+
+def is_context_dependent(query, history_messages):
+    """True when query probably needs the conversation so far to be answered."""
+    if not history_messages:
+        return False
+    return len(query.split()) < MIN_STANDALONE_WORDS or bool(FOLLOW_UP.search(query))
+
+
+class SemanticResponseCache:
+    """LRU of (profile, question embedding) -> answer, matched by cosine similarity.
+
+    profile is any hashable key for the prompt's personalization, e.g.
+    (educationLevel, course). Embeddings must be unit length.
+    """
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL,
+                 min_similarity=RESPONSE_CACHE_SIMILARITY):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.min_similarity = min_similarity
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.saved_seconds = 0.0
+        self._entries = OrderedDict()  # id -> (profile, embedding, response, created, generation seconds)
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0 and self.min_similarity > 0
+
+    def bypass(self):
+        with self._lock:
+            self.bypassed += 1
+
+    def get(self, profile, embedding):
+        """The cached answer for the closest question with this profile, or None."""
+        embedding = np.asarray(embedding, dtype="float32").reshape(-1)
+        now = time.time()
+        with self._lock:
+            for entry_id in [i for i, entry in self._entries.items() if now - entry[3] > self.ttl]:
+                del self._entries[entry_id]
+            candidates = [(i, entry) for i, entry in self._entries.items() if entry[0] == profile]
+            if candidates:
+                similarities = np.stack([entry[1] for _, entry in candidates]) @ embedding
+                best = int(similarities.argmax())
+                if similarities[best] >= self.min_similarity:
+                    entry_id, entry = candidates[best]
+                    self._entries.move_to_end(entry_id)
+                    self.hits += 1
+                    self.saved_seconds += entry[4]
+                    return entry[2]
+            self.misses += 1
+            return None
+
+    def put(self, profile, embedding, response, seconds):
+        """Store response, which took seconds to generate."""
+        embedding = np.asarray(embedding, dtype="float32").reshape(-1)
+        with self._lock:
+            self._entries[self._next_id] = (profile, embedding, response, time.time(), seconds)
+            self._next_id += 1
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "saved_seconds": self.saved_seconds,
+            }
@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from doc_extract import iter_document_text
+from doc_index import (DocumentIndex, context_stats, embed_query, index_chunks, iter_chunks, query_cache,
+                       select_context, stream_hash)
+from encoders import load_encoder
+
+# Thin client for the shared embedding + retrieval service (embed_service.py). All front
+# ends talk to one service process, which holds the only copy of the encoder and one
+# document index, so a document uploaded through any of them is searchable from all.
+#
+# Without EMBED_SERVICE_URL, or while the service cannot be reached, the client loads
+# the encoder and its own document index in-process instead. Nothing is loaded at
+# import time; start_warm_up() loads it in the background while the app starts serving.
+
+EMBED_SERVICE_URL = os.getenv("EMBED_SERVICE_URL", "")  # e.g. http://127.0.0.1:8765
+EMBED_SERVICE_TIMEOUT = float(os.getenv("EMBED_SERVICE_TIMEOUT", "30"))
+EMBED_SERVICE_RETRY = 30  # seconds before an unreachable service is tried again
+
+
+def index_file(embedding_model, doc_index, path, filename, namespace="", progress=None):
+    """Parse, chunk, embed and store the file at path; False when it is already indexed."""
+    # Skip parsing and embedding entirely when this exact file is already indexed
+    with open(path, "rb") as f:
+        doc_hash = stream_hash(f)
+    if doc_index.has_document(doc_hash, namespace):
+        print(f"Document {filename} already indexed, skipping")
+        return False
+
+    # Pages are chunked and embedded as they are extracted
+    chunks = iter_chunks(iter_document_text(path, filename))
+    index_chunks(embedding_model, doc_index, chunks, namespace, doc_hash, filename, progress=progress)
+    return True
+
+
+class RetrievalClient:
+    """Document indexing and retrieval, through the shared service when it is up.
+
+    name is the in-process fallback's own index (e.g. "main"); documents indexed while
+    falling back stay in that index.
+    """
+
+    def __init__(self, name, url=EMBED_SERVICE_URL, dim=384):
+        self.name = name
+        self.url = url.rstrip("/")
+        self.dim = dim
+        self.fallbacks = 0
+        self._retry_at = 0.0
+        self._local = None
+        self._local_lock = threading.Lock()
+        self.ready = False
+        self.warmup_seconds = None
+
+    def _backend(self):
+        """The in-process encoder and index, loaded on first use."""
+        with self._local_lock:
+            if self._local is None:
+                embedding_model = load_encoder()
+                doc_index = DocumentIndex(self.name, self.dim)
+                doc_index.start_maintenance()  # drops expired uploads and reclaims deleted chunks
+                self._local = (embedding_model, doc_index)
+                self.ready = True
+            return self._local
+
+    def warm_up(self):
+        """Reach the service, or load the in-process encoder and index, and embed once."""
+        started = time.perf_counter()
+        try:
+            if self._call("GET", "/health") is None:
+                embedding_model, _ = self._backend()
+                embedding_model.encode("warm up")
+        except Exception as e:
+            print(f"Retrieval warm-up failed ({e}), loading on first request instead")
+            return
+        self.warmup_seconds = time.perf_counter() - started
+        self.ready = True
+        print(f"Retrieval ready in {self.warmup_seconds:.2f}s")
+
+    def start_warm_up(self):
+        threading.Thread(target=self.warm_up, daemon=True).start()
+
+    def _call(self, method, path, payload=None, timeout=EMBED_SERVICE_TIMEOUT):
+        """The service's JSON response, or None when the in-process fallback has to answer."""
+        if not self.url or time.monotonic() < self._retry_at:
+            return None
+        data = json.dumps(payload).encode("utf-8") if payload is not None else None
+        req = urllib.request.Request(self.url + path, data=data, method=method,
+                                     headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(req, timeout=timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError:
+            raise
+        except OSError as e:
+            print(f"Embedding service unavailable ({e}), using the in-process fallback")
+            self._retry_at = time.monotonic() + EMBED_SERVICE_RETRY
+            self.fallbacks += 1
+            return None
+
+    def embed(self, texts):
+        """Normalized embeddings of texts as lists of floats."""
+        result = self._call("POST", "/embed", {"texts": texts})
+        if result is not None:
+            return result["embeddings"]
+        embedding_model, _ = self._backend()
+        return embedding_model.encode(texts, normalize_embeddings=True, convert_to_numpy=True,
+                                      show_progress_bar=False).tolist()
+
+    def embed_query(self, query):
+        """Normalized embedding of a question as a list of floats.
+
+        Goes through the same query cache as select_context, so a question embedded for
+        intent classification is not encoded again for retrieval or the response cache.
+        """
+        result = self._call("POST", "/embed_query", {"query": query})
+        if result is not None:
+            return result["embedding"]
+        embedding_model, _ = self._backend()
+        return embed_query(embedding_model, query)[0].tolist()
+
+    def select_context(self, query, namespace="", max_chunks=5):
+        result = self._call("POST", "/context", {"query": query, "namespace": namespace, "max_chunks": max_chunks})
+        if result is not None:
+            return result["chunks"]
+        embedding_model, doc_index = self._backend()
+        return select_context(embedding_model, doc_index, query, namespace, max_chunks=max_chunks)
+
+    def index_file(self, path, filename, namespace="", progress=None):
+        """Index the file at path (the service reads it from the same disk); False for duplicates."""
+        # Indexing a large upload may take minutes; do not fall back halfway through it
+        try:
+            result = self._call("POST", "/index", {"path": os.path.abspath(path), "filename": filename,
+                                                   "namespace": namespace}, timeout=None)
+        except urllib.error.HTTPError as e:
+            if e.code == 400:
+                raise ValueError(json.loads(e.read()).get("error", "Could not index document"))
+            raise
+        if result is not None:
+            if progress:
+                progress(result["chunks"])
+            return result["indexed"]
+        embedding_model, doc_index = self._backend()
+        return index_file(embedding_model, doc_index, path, filename, namespace, progress)
+
+    def list_documents(self, namespace=""):
+        result = self._call("GET", "/documents?" + urllib.parse.urlencode({"namespace": namespace}))
+        if result is not None:
+            return result["documents"]
+        return self._backend()[1].list_documents(namespace)
+
+    def delete_document(self, doc_hash, namespace=""):
+        """Chunks removed with the document, or None when it is unknown."""
+        try:
+            result = self._call("DELETE", f"/documents/{urllib.parse.quote(doc_hash)}?"
+                                + urllib.parse.urlencode({"namespace": namespace}))
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return None
+            raise
+        if result is not None:
+            return result["chunks_removed"]
+        return self._backend()[1].delete_document(doc_hash, namespace)
+
+    def stats(self):
+        result = self._call("GET", "/metrics")
+        if result is not None:
+            result.update(mode="service", fallbacks=self.fallbacks, ready=self.ready)
+            return result
+        stats = {"mode": "in-process", "fallbacks": self.fallbacks, "ready": self.ready,
+                 "query_embedding_cache": query_cache.stats(), "context_selection": context_stats.stats()}
+        if self._local is not None:
+            stats["document_index"] = self._local[1].stats()
+        return stats
@@ -30,9 +30,10 @@ function sendMessage() {
         formData.append("file", selectedFile);
         if (trimmedInput) formData.append("query", trimmedInput);
         formData.append("username", username);  // Add username to FormData
+        if (socket.connected) formData.append("stream", socket.id);  // indexing progress and streamed answers
 
         const isImage = selectedFile.type.startsWith("image/");
-        appendMessage(isImage ? "🧠 Processing your image..." : "🧠 Processing your file...", "bot");
+        const placeholder = appendMessage(isImage ? "🧠 Processing your image..." : "🧠 Processing your file...", "bot");
 
         fetch("/chat", {
             method: "POST",
@@ -40,16 +41,17 @@ function sendMessage() {
         })
         .then(res => res.json())
         .then(data => {
-            const messages = document.querySelectorAll(".message.bot");
-            const lastBotMessage = messages[messages.length - 1];
-            if (lastBotMessage && lastBotMessage.innerText.includes("Processing")) {
-                lastBotMessage.remove();
-            }
+            // An answer to a question about the file may have been streamed in the meantime;
+            // the final response replaces it
+            placeholder.remove();
+            clearStreamedMessages();
 
             if (data.transcribed) appendMessage(data.transcribed, "user");
             appendMessage(data.response || "🤖 No response.", "bot");
         })
         .catch(err => {
+            placeholder.remove();
+            clearStreamedMessages();
             console.error("File upload error:", err);
             appendMessage("❌ Error processing your file.", "bot");
         });
@@ -62,12 +64,18 @@ function sendMessage() {
             headers: { "Content-Type": "application/json" },
             body: JSON.stringify({ 
                 query: trimmedInput,
-                username: username  // Include username in JSON body
+                username: username,  // Include username in JSON body
+                stream: socket.connected ? socket.id : null  // long answers also arrive token by token over this socket
             })
         })
         .then(response => response.json())
-        .then(data => appendMessage(data.response, "bot"))
+        .then(data => {
+            // The final response replaces whatever was streamed while it was generated
+            clearStreamedMessages();
+            appendMessage(data.response, "bot");
+        })
         .catch(err => {
+            clearStreamedMessages();
             console.error("Text send error:", err);
             appendMessage("❌ Error processing your message.", "bot");
         });
@@ -81,8 +89,38 @@ function appendMessage(text, sender) {
             messageDiv.innerText = text;
             chatContainer.appendChild(messageDiv);
             chatContainer.scrollTop = chatContainer.scrollHeight;
+            return messageDiv;
+}
+
+const streamedMessages = {};
+
+socket.on("answer_start", function(data) {
+    streamedMessages[data.stream_id] = appendMessage("", "bot");
+});
+
+socket.on("answer_token", function(data) {
+    const messageDiv = streamedMessages[data.stream_id];
+    if (!messageDiv) return;
+    messageDiv.innerText += data.text;
+    const chatContainer = document.getElementById("chat-container");
+    chatContainer.scrollTop = chatContainer.scrollHeight;
+});
+
+function clearStreamedMessages() {
+    for (const streamId in streamedMessages) {
+        streamedMessages[streamId].remove();
+        delete streamedMessages[streamId];
+    }
 }
 
+socket.on("ingest_progress", function(job) {
+    if (job.status === "done") {
+        appendMessage(`📄 ${job.filename} is fully indexed (${job.chunks} chunks).`, "bot");
+    } else if (job.status === "failed") {
+        appendMessage(`❌ Failed to index ${job.filename}.`, "bot");
+    }
+});
+
 socket.on("start_timer", function(data) {
     timeLeft = data.seconds;
     if (!timerActive) {
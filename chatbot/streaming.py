@@ -0,0 +1,88 @@
+import re
+import threading
+from collections import deque
+import numpy as np
+
+# Helpers for streaming LLM answers to the browser token by token (see /chat's
+# "stream" flag in main.py): clean_response applied incrementally, and time-to-first-
+# token statistics.
+
+STREAM_STATS_WINDOW = 1000  # recent answers the percentiles are computed over
+
+
+def strip_markdown(text):
+    # Remove asterisk-based markdown (e.g., *text*, **text**)
+    text = re.sub(r'\*\*(.*?)\*\*', r'\1', text)
+    text = re.sub(r'\*(.*?)\*', r'\1', text)
+    return text
+
+
+class ResponseCleaner:
+    """clean_response (strip_markdown, then strip) applied to an answer piece by piece.
+
+    The asterisk patterns never span a newline, so finished lines are cleaned for good
+    and the unfinished line is held back from its first asterisk on. Trailing whitespace
+    is held until more text follows it. Everything feed() and finish() return adds up
+    to clean_response of the whole answer.
+    """
+
+    def __init__(self, markdown=True):
+        self.markdown = markdown
+        self.pending = ""
+        self.whitespace = ""
+        self.started = False
+
+    def feed(self, text):
+        self.pending += text
+        head, newline, line = self.pending.rpartition("\n")
+        star = line.find("*") if self.markdown else -1
+        if star == -1:
+            ready, self.pending = self.pending, ""
+        else:
+            ready, self.pending = head + newline + line[:star], line[star:]
+        return self._emit(ready)
+
+    def finish(self):
+        text = self._emit(self.pending)
+        self.pending = ""
+        self.whitespace = ""
+        return text
+
+    def _emit(self, text):
+        if self.markdown:
+            text = strip_markdown(text)
+        if not self.started:
+            text = text.lstrip()
+            self.started = bool(text)
+        text = self.whitespace + text
+        stripped = text.rstrip()
+        self.whitespace = text[len(stripped):]
+        return stripped
+
+
+class StreamStats:
+    """Time to first token and total generation time of streamed answers."""
+
+    def __init__(self, window=STREAM_STATS_WINDOW):
+        self.streams = 0
+        self._first_token = deque(maxlen=window)
+        self._total = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, first_token_seconds, total_seconds):
+        with self._lock:
+            self.streams += 1
+            if first_token_seconds is not None:
+                self._first_token.append(first_token_seconds)
+            self._total.append(total_seconds)
+
+    def stats(self):
+        with self._lock:
+            first_token = np.array(self._first_token)
+            total = np.array(self._total)
+        summary = {"streams": self.streams}
+        for name, samples in (("ttft", first_token), ("total", total)):
+            if len(samples):
+                summary[f"{name}_p50_seconds"] = float(np.percentile(samples, 50))
+                summary[f"{name}_p95_seconds"] = float(np.percentile(samples, 95))
+        return summary
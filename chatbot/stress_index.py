@@ -0,0 +1,155 @@
+import sys
+import time
+import random
+import argparse
+import tempfile
+import threading
+import numpy as np
+import doc_index
+from doc_index import DocumentIndex
+
+# Hammers one DocumentIndex with concurrent uploads, deletes, compactions and queries,
+# then checks that nothing was lost or mixed up between namespaces:
+#
+#   python stress_index.py
+#   python stress_index.py --writers 8 --readers 16 --seconds 30 --ann-threshold 5000
+#
+# Every search result must be a chunk of the searched namespace, and after the run each
+# namespace must hold exactly the chunks its writers stored and did not delete, also
+# after reopening the index from disk.
+
+
+def run(args):
+    doc_index.ANN_THRESHOLD = args.ann_threshold
+    data_dir = tempfile.mkdtemp(prefix="stress_index_")
+    index = DocumentIndex("stress", args.dim, data_dir)
+    namespaces = [f"user{i}" for i in range(args.namespaces)]
+
+    stored = {ns: set() for ns in namespaces}
+    stored_lock = threading.Lock()
+    errors = []
+    counts = {"batches": 0, "deletes": 0, "compactions": 0, "searches": 0}
+    stop = threading.Event()
+
+    def fail(message):
+        errors.append(message)
+        stop.set()
+
+    def writer(seed):
+        rng = np.random.default_rng(seed)
+        documents = []
+        while not stop.is_set():
+            ns = namespaces[rng.integers(len(namespaces))]
+            vectors = rng.standard_normal((args.batch, args.dim)).astype("float32")
+            chunks = [f"{ns} chunk {seed}-{len(documents)}-{j} topic{rng.integers(50)}" for j in range(args.batch)]
+            try:
+                ids = index.add(vectors, chunks, ns)
+                index.add_document(f"{seed}-{ids[0]}", ids, ns, "stress.txt")
+                documents.append((ns, f"{seed}-{ids[0]}", ids))
+                with stored_lock:
+                    stored[ns].update(ids)
+                    counts["batches"] += 1
+                if rng.random() < args.delete_ratio:
+                    ns, doc_hash, ids = documents.pop(rng.integers(len(documents)))
+                    if index.delete_document(doc_hash, ns) != len(ids):
+                        fail(f"writer {seed}: deleting {doc_hash} did not remove its {len(ids)} chunks")
+                    with stored_lock:
+                        stored[ns].difference_update(ids)
+                        counts["deletes"] += 1
+            except Exception as e:
+                fail(f"writer {seed}: {e!r}")
+                return
+
+    def compactor():
+        while not stop.wait(args.compact_every):
+            try:
+                index.compact()
+            except Exception as e:
+                fail(f"compactor: {e!r}")
+                return
+            counts["compactions"] += 1
+
+    def reader(seed):
+        rng = random.Random(seed)
+        query = np.random.default_rng(seed).standard_normal((1, args.dim)).astype("float32")
+        while not stop.is_set():
+            ns = rng.choice(namespaces)
+            try:
+                distances, ids = index.search(query, 10, ns)
+                found = [int(i) for i in ids if i >= 0]
+                if len(set(found)) != len(found):
+                    fail(f"duplicate ids in {ns}: {found}")
+                if np.any(np.diff(distances[ids >= 0]) < -1e-4):
+                    fail(f"unsorted distances in {ns}: {distances}")
+                texts = index.get_texts(found)
+                if len(texts) != len(found) and not args.delete_ratio:
+                    fail(f"{ns}: search returned ids without committed text")
+                if any(not text.startswith(ns + " ") for text in texts):
+                    fail(f"{ns}: search returned another namespace's chunk")
+                lexical = index.get_texts(index.lexical_search(f"topic{rng.randrange(50)}", 5, ns))
+                if any(not text.startswith(ns + " ") for text in lexical):
+                    fail(f"{ns}: lexical search returned another namespace's chunk")
+            except Exception as e:
+                fail(f"reader {seed}: {e!r}")
+                return
+            with stored_lock:
+                counts["searches"] += 1
+
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(args.writers)]
+    threads += [threading.Thread(target=reader, args=(1000 + i,)) for i in range(args.readers)]
+    threads.append(threading.Thread(target=compactor))
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    stop.wait(args.seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    total = sum(len(ids) for ids in stored.values())
+    print(f"{args.writers} writers, {args.readers} readers, {elapsed:.1f}s: "
+          f"{counts['batches']} batches added ({counts['batches'] * args.batch / elapsed:.0f} chunks/sec), "
+          f"{counts['deletes']} deleted, {total} chunks left, {counts['compactions']} compactions, "
+          f"{counts['searches']} vector + lexical query rounds ({counts['searches'] / elapsed:.0f}/sec)")
+
+    # Let a promotion that is still building finish before checking counts
+    while any(index.index(ns)._rebuilding for ns in namespaces):
+        time.sleep(0.1)
+    print("  index:", index.stats())
+    reopened = DocumentIndex("stress", args.dim, data_dir)
+    for ns in namespaces:
+        live = index.index(ns)
+        print(f"  {ns}: {len(stored[ns])} stored, {live.ntotal} indexed as {live.kind} "
+              f"in {len(live.segments)} segments, {reopened.index(ns).ntotal} after reopening")
+        for name, ns_index in (("live", live), ("reopened", reopened.index(ns))):
+            ids = np.concatenate([doc_index.segment_ids(s) for s in ns_index.segments]) if ns_index.segments else []
+            ids = np.setdiff1d(ids, ns_index.deleted)
+            if set(int(i) for i in ids) != stored[ns] or len(ids) != len(stored[ns]):
+                errors.append(f"{ns}: {name} index does not hold exactly the stored chunks")
+    if reopened.ntotal != total or index.ntotal != total:
+        errors.append(f"expected {total} chunks, index has {index.ntotal}, reopened {reopened.ntotal}")
+
+    for error in errors[:20]:
+        print("FAIL:", error)
+    print("OK" if not errors else f"{len(errors)} failures")
+    return not errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent upload + query stress test for DocumentIndex")
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--namespaces", type=int, default=3)
+    parser.add_argument("--batch", type=int, default=32, help="chunks per upload batch")
+    parser.add_argument("--dim", type=int, default=64)
+    parser.add_argument("--ann-threshold", type=int, default=2000, help="low so promotion runs during the test")
+    parser.add_argument("--delete-ratio", type=float, default=0.3, help="chance a writer deletes one of its documents after an upload")
+    parser.add_argument("--compact-every", type=float, default=1.0, help="seconds between compactions")
+    args = parser.parse_args()
+    sys.exit(0 if run(args) else 1)
+
+
+if __name__ == "__main__":
+    main()
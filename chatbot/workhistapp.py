@@ -2,19 +2,20 @@ import json
 from flask import Flask, request, jsonify, render_template, session
 from flask_cors import CORS
 from flask_socketio import SocketIO
-import groq
 import re
 import threading
 from datetime import datetime, timedelta
 import os
+import hashlib
+import tempfile
 from twilio.rest import Client as TwilioClient
 from dotenv import load_dotenv
 import base64
-from PyPDF2 import PdfReader
-import docx
-import faiss
-import numpy as np
-from sentence_transformers import SentenceTransformer
+from retrieval_client import RetrievalClient
+from intent_classifier import IntentClassifier
+from intent_rules import classify_intent, extract_time
+from llm_gateway import LLMUnavailable, make_client
+from model_routing import route
 from langchain_community.chat_message_histories import ChatMessageHistory
 from langchain_core.messages import HumanMessage, AIMessage
 
@@ -42,17 +43,35 @@ def handle_options():
         response.headers.add("Access-Control-Allow-Methods", "GET,PUT,POST,DELETE,OPTIONS")
         response.headers.add("Access-Control-Allow-Credentials", "true")
         return response
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode="threading")
 
 groq_api_key = os.getenv("GROQ_API_KEY")
-client = groq.Client(api_key=groq_api_key) 
+client = make_client(groq_api_key)  # queued, retried and circuit-broken per model
 
-embedding_model = SentenceTransformer("all-MiniLM-L6-v2")
+# Document embedding and retrieval: the shared service when EMBED_SERVICE_URL is set,
+# otherwise an in-process encoder and persistent index (see retrieval_client.py)
+retrieval = RetrievalClient("workhist")
 
-# Global index and mapping
-index = faiss.IndexFlatL2(384)  # For all-MiniLM-L6-v2
-id_to_text = {}
-next_id = 0 
+# Intents are classified by rules, then by the encoder above, then by the LLM
+intent_classifier = IntentClassifier(retrieval.embed, embed_query=retrieval.embed_query)
+
+# Loaded in the background once per serving process: from __main__, or on the first
+# request when a server such as gunicorn imports the app instead
+warm_up_lock = threading.Lock()
+warm_up_started = False
+
+def start_warm_up():
+    global warm_up_started
+    with warm_up_lock:
+        if warm_up_started:
+            return
+        warm_up_started = True
+    retrieval.start_warm_up()
+    threading.Thread(target=intent_classifier.fit, daemon=True).start()
+
+@app.before_request
+def warm_up_on_first_request():
+    start_warm_up()
 
 # Session storage for conversation histories
 session_histories = {}
@@ -85,7 +104,7 @@ def detect_intent_llm(text):
     ]
 
     response = client.chat.completions.create(
-        model="llama3-70b-8192",
+        **route("classify"),
         messages=prompt
     )
 
@@ -118,7 +137,7 @@ def extract_time_llm(text):
     ]
 
     response = client.chat.completions.create(
-        model="llama3-70b-8192",
+        **route("extract_time"),
         messages=prompt
     )
 
@@ -161,7 +180,7 @@ def start_timer(seconds):
     socketio.emit("start_timer", {"seconds": seconds})  # Send initial time
     threading.Timer(seconds, lambda: socketio.emit("timer_finished", {"message": "✅ Timer finished! Take a short break! ☕"})).start()
 
-def generate_response_with_history(query, session_id):
+def generate_response_with_history(query, session_id, intent="general_query"):
     # Get the conversation history
     history = get_session_history(session_id)
     
@@ -182,7 +201,7 @@ def generate_response_with_history(query, session_id):
     
     # Generate response
     response = client.chat.completions.create(
-        model="llama-3.3-70b-versatile", 
+        **route(intent),
         messages=messages
     )
     
@@ -211,7 +230,7 @@ def generate_greeting_response(user_input, session_id):
     messages.append({"role": "user", "content": user_input})
     
     response = client.chat.completions.create(
-        model="llama-3.3-70b-versatile",
+        **route("greeting"),
         messages=messages
     )
     
@@ -227,7 +246,7 @@ def transcribe_audio_to_text(audio_path):
     with open(audio_path, "rb") as file:
         transcription = client.audio.transcriptions.create(
             file=(audio_path, file.read()),
-            model="whisper-large-v3-turbo",
+            **route("transcribe"),
             response_format="verbose_json",
             language="en"
         )
@@ -248,7 +267,7 @@ def handle_image_query(image_file, query=None):
     chat_prompt = query if query else "Describe this image in a very few lines.Dont provide extra context strictly follow this."
 
     response = client.chat.completions.create(
-        model="llama-3.2-11b-vision-preview",
+        **route("image"),
         messages=[
             {
                 "role": "user",
@@ -264,29 +283,14 @@ def handle_image_query(image_file, query=None):
 def is_image(file):
     return file.mimetype.startswith('image/')
 
-def extract_text(file):
-    ext = file.filename.lower()
-    if ext.endswith(".pdf"):
-        reader = PdfReader(file)
-        return "\n".join(page.extract_text() for page in reader.pages if page.extract_text())
-    elif ext.endswith(".docx"):
-        doc = docx.Document(file)
-        return "\n".join([para.text for para in doc.paragraphs])
-    elif ext.endswith(".txt"):
-        return file.read().decode("utf-8")
-    else:
-        raise ValueError("Unsupported file type")
-    
-def store_file_and_index(file):
-    global next_id
-    text = extract_text(file)
-    chunks = [text[i:i+500] for i in range(0, len(text), 500)]
-
-    for chunk in chunks:
-        embedding = embedding_model.encode(chunk, normalize_embeddings=True).astype("float32")
-        index.add(np.array([embedding]))
-        id_to_text[next_id] = chunk
-        next_id += 1
+def store_file_and_index(file, namespace=""):
+    # Saved to disk so the shared embedding service can read it too
+    with tempfile.NamedTemporaryFile(suffix=os.path.basename(file.filename), delete=False) as tmp:
+        file.save(tmp)
+    try:
+        return retrieval.index_file(tmp.name, file.filename, namespace)
+    finally:
+        os.remove(tmp.name)
 
 def generate_llama_response_with_context(query, context, session_id):
     history = get_session_history(session_id)
@@ -312,7 +316,7 @@ Question:
     messages.append({"role": "user", "content": final_prompt})
     
     response = client.chat.completions.create(
-        model="llama-3.3-70b-versatile",
+        **route("document_query"),
         messages=messages
     )
     
@@ -323,19 +327,15 @@ Question:
     
     return raw_response
 
-def retrieve_relevant_text(query, top_k=5):
-    query_embedding = embedding_model.encode(query, normalize_embeddings=True).reshape(1, -1).astype("float32")
-    distances, indices = index.search(query_embedding, top_k)
-    retrieved = [id_to_text.get(i, "") for i in indices[0] if i >= 0]
-    return "\n".join(retrieved) if retrieved else "No relevant context found."
-
 @app.route("/chat", methods=['POST', 'OPTIONS'])
 def chat():
     if request.method == 'OPTIONS':
         # Preflight request
         return jsonify({'message': 'CORS preflight'}), 200
     # Generate or retrieve session ID
-    session_id = request.cookies.get('session_id') or str(hash(request.remote_addr))
+    # Stable across restarts (built-in hash() of a str is salted per process), so
+    # documents persisted under this namespace stay reachable
+    session_id = request.cookies.get('session_id') or hashlib.sha256((request.remote_addr or "").encode("utf-8")).hexdigest()
     
     transcribed = None
     file = request.files.get("file")
@@ -347,19 +347,26 @@ def chat():
             try:
                 response_text = handle_image_query(file, query)
                 return jsonify({"response": response_text})
+            except LLMUnavailable:
+                raise  # answered with a 503 by llm_unavailable
             except Exception as e:
                 print("Image handling error:", e)
                 return jsonify({"response": "❌ Failed to process the image."}), 500
 
         elif any(file.filename.lower().endswith(ext) for ext in [".txt", ".pdf", ".docx"]):
             try:
-                store_file_and_index(file)
+                store_file_and_index(file, session_id)
                 if query:
-                    context = retrieve_relevant_text(query)
-                    response_text = generate_llama_response_with_context(query, context, session_id)
+                    chunks = retrieval.select_context(query, session_id)
+                    if chunks:
+                        response_text = generate_llama_response_with_context(query, "\n".join(chunks), session_id)
+                    else:
+                        response_text = generate_response_with_history(query, session_id)
                     return jsonify({"response": response_text})
                 else:
                     return jsonify({"response": "📁 File processed. Ask your question related to the content."})
+            except LLMUnavailable:
+                raise  # answered with a 503 by llm_unavailable
             except Exception as e:
                 print("Document handling error:", e)
                 return jsonify({"response": "❌ Failed to process the document."}), 500
@@ -387,7 +394,7 @@ def chat():
         })
 
     # Intent Detection and Execution
-    sub_queries = detect_intent_llm(user_input)
+    sub_queries = classify_intent(user_input, detect_intent_llm, intent_classifier)  # LLM only when unsure
     print("Detected sub-queries:", sub_queries)
 
     responses = []
@@ -401,7 +408,7 @@ def chat():
             responses.append(generate_greeting_response(query, session_id))
 
         elif intent in ["study_schedule", "set_reminder"]:
-            time_data = extract_time_llm(query)
+            time_data = extract_time(item, extract_time_llm)
             print("Time LLM Output:", time_data)
 
             if time_data:
@@ -431,7 +438,7 @@ def chat():
                 responses.append("⌛ I can set up your study session, but I need a valid time. When should we start? 🕒")
 
         elif intent == "motivation":
-            responses.append(generate_response_with_history(query, session_id))
+            responses.append(generate_response_with_history(query, session_id, intent))
 
         else:  # general_query or fallback
             responses.append(generate_response_with_history(query, session_id))
@@ -441,9 +448,18 @@ def chat():
         "transcribed": transcribed
     })
 
+@app.errorhandler(LLMUnavailable)
+def llm_unavailable(e):
+    """The LLM is rate limited or failing: answer quickly instead of with a 500."""
+    print(f"LLM unavailable: {e}")
+    return jsonify({"response": "⏳ The study buddy is busy right now. Please try again in a moment."}), 503
+
 @app.route("/")
 def home():
     return render_template("index.html")
 
 if __name__ == "__main__":
-    socketio.run(app, host="0.0.0.0", port=8000, debug=True)
\ No newline at end of file
+    # The debug reloader runs this file twice; only the serving child warms up
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_warm_up()
+    socketio.run(app, host="0.0.0.0", port=8000, debug=True, allow_unsafe_werkzeug=True)
\ No newline at end of file
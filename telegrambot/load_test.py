@@ -0,0 +1,95 @@
+import sys
+import time
+import json
+import asyncio
+import argparse
+from types import SimpleNamespace
+
+import telehist
+
+# Load test for the bot's message handling: N chats send messages at the same time and
+# every message goes through telehist.process_input. Groq is replaced by a client that
+# waits --llm-ms per completion and retrieval by a blocking --embed-ms sleep, so the
+# run shows whether chats are served concurrently and whether the event loop stays
+# responsive (heartbeat lag) while they are. Needs the bot's requirements installed,
+# but no Telegram or Groq credentials.
+#
+#   python load_test.py --chats 20 --messages 3
+
+
+class FakeCompletions:
+    def __init__(self, latency):
+        self.latency = latency
+
+    async def create(self, model, messages, **kwargs):
+        await asyncio.sleep(self.latency)
+        if "classifies" in messages[0]["content"]:
+            content = json.dumps([{"query": messages[-1]["content"], "intent": "general_query"}])
+        else:
+            content = "Here is a short explanation."
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+class FakeMessage:
+    def __init__(self, replies):
+        self.replies = replies
+
+    async def reply_text(self, text):
+        self.replies.append(time.perf_counter())
+
+
+async def heartbeat(interval, lags, stop):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - started - interval)
+
+
+async def run(chats, messages, llm_seconds, embed_seconds):
+    telehist.client = SimpleNamespace(chat=SimpleNamespace(completions=FakeCompletions(llm_seconds)))
+    telehist.intent_classifier = None  # questions go to the (fake) LLM classifier
+    telehist.retrieve_relevant_text = lambda query, top_k=5, namespace="": time.sleep(embed_seconds) or ""
+
+    replies = []
+    lags = []
+    stop = asyncio.Event()
+    beat = asyncio.create_task(heartbeat(0.01, lags, stop))
+
+    async def chat(chat_id):
+        update = SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id), message=FakeMessage(replies))
+        for i in range(messages):
+            await telehist.process_input(update, SimpleNamespace(), f"explain limits in calculus, part {i}")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(chat(1000 + i) for i in range(chats)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await beat
+    return elapsed, len(replies), max(lags) if lags else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that the Telegram bot serves chats concurrently")
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=3, help="messages per chat, sent one after another")
+    parser.add_argument("--llm-ms", type=float, default=500, help="latency of each fake completion")
+    parser.add_argument("--embed-ms", type=float, default=20, help="blocking retrieval time per question")
+    parser.add_argument("--max-lag-ms", type=float, default=100, help="fail when the event loop stalls longer")
+    args = parser.parse_args()
+
+    elapsed, answered, max_lag = asyncio.run(run(args.chats, args.messages, args.llm_ms / 1000, args.embed_ms / 1000))
+    per_message = 2 * args.llm_ms / 1000 + args.embed_ms / 1000  # classify, retrieve, answer
+    serial = args.chats * args.messages * per_message
+    one_chat = args.messages * per_message
+    print(f"{args.chats} chats x {args.messages} messages: {answered} answered in {elapsed:.2f}s "
+          f"(one chat alone {one_chat:.2f}s, all chats in series {serial:.2f}s)")
+    print(f"speedup over serial {serial / elapsed:.1f}x, max event loop lag {1000 * max_lag:.0f} ms")
+
+    concurrent = elapsed < 1.5 * one_chat  # in series it would take args.chats times as long
+    ok = answered == args.chats * args.messages and concurrent and 1000 * max_lag <= args.max_lag_ms
+    print("OK" if ok else "FAIL")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
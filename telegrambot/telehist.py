@@ -1,4 +1,5 @@
 import os
+import sys
 import json
 import re
 import threading
@@ -6,26 +7,30 @@ import base64
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import tempfile
-from telegram import Update, Audio, Voice, PhotoSize
+from telegram import Update, Voice
 from telegram.ext import ApplicationBuilder, ContextTypes, MessageHandler, CommandHandler, filters
 import asyncio
-import groq
+from concurrent.futures import ThreadPoolExecutor
 from twilio.rest import Client as TwilioClient
-from PyPDF2 import PdfReader
-import docx
-import numpy as np
-import faiss
-from sentence_transformers import SentenceTransformer
 from langchain_community.chat_message_histories import ChatMessageHistory
-from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain_core.messages import HumanMessage, AIMessage
 from collections import defaultdict
 
+# Shared document indexing helpers live next to the web chatbot
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "chatbot"))
+from retrieval_client import RetrievalClient
+from intent_classifier import IntentClassifier
+from intent_rules import classify_intent_async, extract_time_async
+from llm_gateway import LLMUnavailable, make_async_client, set_requester
+from model_routing import route
+
 load_dotenv()
 
 # --- Setup ---
 groq_api_key = os.getenv("GROQ_API_KEY")
-client = groq.Client(api_key=groq_api_key)
+# Awaited, so a slow completion never blocks other chats; queued, retried and
+# circuit-broken per model by the shared gateway (chatbot/llm_gateway.py)
+client = make_async_client(groq_api_key)
 
 twilio_sid = os.getenv("TWILIO_SID")
 twilio_token = os.getenv("TWILIO_TOKEN")
@@ -35,14 +40,26 @@ user_phone_number = os.getenv("USED_PHONE_NUMBER")
 twilio_client = TwilioClient(twilio_sid, twilio_token)
 
 # --- Document Indexing Setup ---
-embedding_dim = 384  # Dimension of embeddings
-embedding_model = SentenceTransformer('all-MiniLM-L6-v2')  
-index = faiss.IndexFlatL2(embedding_dim)
-id_to_text = {}
-next_id = 0
+# The shared embedding service when EMBED_SERVICE_URL is set, otherwise an in-process
+# encoder and an index persisted under chatbot/index_data/telegram
+retrieval = RetrievalClient("telegram")
+
+# Intents are classified by rules, then by the encoder above, then by the LLM
+intent_classifier = IntentClassifier(retrieval.embed, embed_query=retrieval.embed_query)
+
+# Encoding, index access and Twilio calls block; they run here, off the event loop
+BLOCKING_WORKERS = int(os.getenv("BLOCKING_WORKERS", "4"))
+blocking_executor = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS)
+
+async def run_blocking(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(blocking_executor, func, *args)
+
+# Updates from different chats are handled concurrently, up to this many at once
+BOT_CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "64"))
 
 # --- Chat History Setup ---
 store = defaultdict(ChatMessageHistory)
+chat_locks = defaultdict(asyncio.Lock)  # one message per chat at a time keeps its history in order
 
 def get_session_history(session_id: str) -> ChatMessageHistory:
     return store[session_id]
@@ -60,7 +77,7 @@ def make_call(message):
     twiml = f'<Response><Say>{message}</Say></Response>'
     twilio_client.calls.create(twiml=twiml, to=user_phone_number, from_=twilio_number)
 
-def detect_intent_llm(text):
+async def detect_intent_llm(text):
     prompt = [
         {"role": "system", "content": (
             "You are an AI that extracts and classifies multiple intents from a user message.\n"
@@ -71,7 +88,7 @@ def detect_intent_llm(text):
         )},
         {"role": "user", "content": f"User message: {text}"}
     ]
-    response = client.chat.completions.create(model="llama3-70b-8192", messages=prompt)
+    response = await client.chat.completions.create(**route("classify"), messages=prompt)
     try:
         result = json.loads(response.choices[0].message.content)
         valid_intents = ["greeting", "study_schedule", "set_reminder", "motivation", "general_query"]
@@ -80,7 +97,7 @@ def detect_intent_llm(text):
         print("Intent parsing error:", e)
         return [{"query": text, "intent": "general_query"}]
 
-def extract_time_llm(text):
+async def extract_time_llm(text):
     prompt = [
         {
             "role": "system",
@@ -98,14 +115,14 @@ def extract_time_llm(text):
         },
         {"role": "user", "content": f"Query: {text}"}
     ]
-    response = client.chat.completions.create(model="llama3-70b-8192", messages=prompt)
+    response = await client.chat.completions.create(**route("extract_time"), messages=prompt)
     try:
         return json.loads(response.choices[0].message.content.strip())
     except Exception as e:
         print("LLM Time Parse Error:", e)
         return None
 
-def generate_response(query, chat_history=None):
+async def generate_response(query, chat_history=None, intent="general_query"):
     # Prepare message history
     messages = [{"role": "system", "content": "You are an Mathematical AI Study Assistant.you have to provide the accurate mathmatical solutions for the students. Help students with study schedules, reminders, and motivation. Provide minimal and engaging responses. Keep answers concise."}]
     
@@ -118,13 +135,13 @@ def generate_response(query, chat_history=None):
     
     messages.append({"role": "user", "content": query})
     
-    response = client.chat.completions.create(
-        model="llama3-70b-8192",
+    response = await client.chat.completions.create(
+        **route(intent),
         messages=messages
     )
     return clean_response(response.choices[0].message.content)
 
-def generate_greeting_response(user_input, chat_history=None):
+async def generate_greeting_response(user_input, chat_history=None):
     messages = [{"role": "system", "content": "You are a friendly and gamified Mathematical AI Study Buddy. Your tone should be fun, engaging, and motivational. Provide minimal and engaging responses.make the responses short and sweet."}]
     
     if chat_history:
@@ -136,17 +153,17 @@ def generate_greeting_response(user_input, chat_history=None):
     
     messages.append({"role": "user", "content": user_input})
     
-    response = client.chat.completions.create(
-        model="llama3-70b-8192",
+    response = await client.chat.completions.create(
+        **route("greeting"),
         messages=messages
     )
     return clean_response(response.choices[0].message.content)
 
-def transcribe_audio_to_text(audio_path):
+async def transcribe_audio_to_text(audio_path):
     with open(audio_path, "rb") as file:
-        transcription = client.audio.transcriptions.create(
+        transcription = await client.audio.transcriptions.create(
             file=(audio_path, file.read()),
-            model="whisper-large-v3-turbo",
+            **route("transcribe"),
             response_format="verbose_json",
             language="en"
         )
@@ -168,6 +185,7 @@ async def countdown_timer(context, chat_id, seconds):
 
 # --- Image and Document Handling ---
 async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    set_requester(update.effective_chat.id)
     photo = update.message.photo[-1]  # Get highest resolution photo
     file = await context.bot.get_file(photo.file_id)
     
@@ -175,12 +193,12 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await file.download_to_drive(tmp.name)
         with open(tmp.name, "rb") as image_file:
             caption = update.message.caption or "Describe this image"
-            response = handle_image_query(image_file, caption)
+            response = await handle_image_query(image_file, caption)
     
     os.remove(tmp.name)
     await update.message.reply_text(response)
 
-def handle_image_query(image_file, query=None):
+async def handle_image_query(image_file, query=None):
     image_bytes = image_file.read()
     mime_type = "image/jpeg"  # Telegram sends as JPEG
     
@@ -199,8 +217,8 @@ def handle_image_query(image_file, query=None):
     chat_prompt = query if query else "Describe this image in a very few lines.Don't provide extra context strictly follow this."
 
     # Send to llama-3.2-11b-vision-preview via Groq client
-    response = client.chat.completions.create(
-        model="llama-3.2-11b-vision-preview",
+    response = await client.chat.completions.create(
+        **route("image"),
         messages=[
             {
                 "role": "user",
@@ -220,9 +238,11 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     with tempfile.NamedTemporaryFile(suffix=document.file_name, delete=False) as tmp:
         await file.download_to_drive(tmp.name)
         try:
-            text = extract_text(tmp)
-            store_file_and_index(tmp)
-            response = "📄 Document processed and indexed!"
+            if await run_blocking(store_file_and_index, tmp, str(update.effective_chat.id),
+                                  document.file_name):
+                response = "📄 Document processed and indexed!"
+            else:
+                response = "📄 This document is already indexed!"
         except ValueError as e:
             response = f"❌ Error: {str(e)}"
         except Exception as e:
@@ -232,32 +252,10 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     os.remove(tmp.name)
     await update.message.reply_text(response)
 
-def extract_text(file):
-    filename = file.name.lower()
-    if filename.endswith(".pdf"):
-        reader = PdfReader(file.name)
-        return "\n".join(page.extract_text() for page in reader.pages if page.extract_text())
-    elif filename.endswith(".docx"):
-        doc = docx.Document(file.name)
-        return "\n".join([para.text for para in doc.paragraphs])
-    elif filename.endswith(".txt"):
-        with open(file.name, "r") as f:
-            return f.read()
-    else:
-        raise ValueError("Unsupported file type")
+def store_file_and_index(file, namespace="", filename=None):
+    return retrieval.index_file(file.name, filename or file.name, namespace)
 
-def store_file_and_index(file):
-    global next_id
-    text = extract_text(file)
-    chunks = [text[i:i+500] for i in range(0, len(text), 500)]
-
-    for chunk in chunks:
-        embedding = embedding_model.encode(chunk, normalize_embeddings=True).astype("float32")
-        index.add(np.array([embedding]))
-        id_to_text[next_id] = chunk
-        next_id += 1
-
-def generate_llama_response_with_context(query, context, chat_history=None):
+async def generate_llama_response_with_context(query, context, chat_history=None):
     final_prompt = f"""You are a Excellent mathematical AI Study assistant.make sure you answer the mathematical problem very accurate. Use the following context to answer the question.
 
 Context:
@@ -277,79 +275,80 @@ Question:
     
     messages.append({"role": "user", "content": final_prompt})
     
-    chat_completion = client.chat.completions.create(
-        model="llama-3.3-70b-versatile",
+    chat_completion = await client.chat.completions.create(
+        **route("document_query"),
         messages=messages
     )
     return chat_completion.choices[0].message.content.strip()
 
-def retrieve_relevant_text(query, top_k=5):
-    query_embedding = embedding_model.encode(query, normalize_embeddings=True).reshape(1, -1).astype("float32")
-    distances, indices = index.search(query_embedding, top_k)
-
-    retrieved = [id_to_text.get(i, "") for i in indices[0] if i >= 0]
+def retrieve_relevant_text(query, top_k=5, namespace=""):
+    retrieved = retrieval.select_context(query, namespace, max_chunks=top_k)
     return "\n".join(retrieved) if retrieved else "No relevant context found."
 
+async def alarm_after(context, chat_id, delay, time_text):
+    await asyncio.sleep(delay)
+    await run_blocking(send_sms, f"Reminder: Your session is at {time_text}")
+    await run_blocking(make_call, f"This is your Study Buddy. It's time to study at {time_text}")
+    await context.bot.send_message(chat_id=chat_id, text="📞 Alarm triggered!")
+
 # --- Core Message Processing ---
 async def process_input(update: Update, context: ContextTypes.DEFAULT_TYPE, user_input: str):
     # Get or create chat history for this session
     chat_id = str(update.effective_chat.id)
-    chat_history = get_session_history(chat_id)
-    
-    # Add user message to history
-    chat_history.add_user_message(user_input)
-    
-    responses = []
-    sub_queries = detect_intent_llm(user_input)
-
-    for item in sub_queries:
-        query = item["query"]
-        intent = item["intent"]
-
-        if intent == "greeting":
-            response = generate_greeting_response(query, chat_history)
-            responses.append(response)
-
-        elif intent in ["study_schedule", "set_reminder"]:
-            time_data = extract_time_llm(query)
-            if time_data:
-                if time_data["type"] == "relative":
-                    asyncio.create_task(countdown_timer(context,update.effective_chat.id,time_data["seconds"]))
-                elif time_data["type"] == "absolute":
-                    def alarm():
-                        send_sms(f"Reminder: Your session is at {time_data['time']}")
-                        make_call(f"This is your Study Buddy. It's time to study at {time_data['time']}")
-                        context.bot.send_message(chat_id=update.effective_chat.id, text="📞 Alarm triggered!")
-                    now = datetime.now()
-                    target = datetime.strptime(time_data["time"], "%I:%M %p").replace(
-                        year=now.year, month=now.month, day=now.day)
-                    if target < now:
-                        target += timedelta(days=1)
-                    delay = (target - now).total_seconds()
-                    threading.Timer(delay, alarm).start()
-                    responses.append(f"⏰ Alarm set for {time_data['time']}")
-            else:
-                responses.append("⌛ Please give a valid time to schedule.")
-
-        elif intent == "motivation":
-            response = generate_response(query, chat_history)
-            responses.append(response)
-        else:
-            # Check if we have document context to use
-            context_text = retrieve_relevant_text(query)
-            if context_text and "No relevant context" not in context_text:
-                response = generate_llama_response_with_context(query, context_text, chat_history)
-                responses.append(response)
-            else:
-                response = generate_response(query, chat_history)
+    set_requester(chat_id)  # LLM calls are queued fairly between chats
+    async with chat_locks[chat_id]:
+        chat_history = get_session_history(chat_id)
+        
+        # Add user message to history
+        chat_history.add_user_message(user_input)
+        
+        responses = []
+        sub_queries = await classify_intent_async(user_input, detect_intent_llm, intent_classifier, blocking_executor)
+
+        for item in sub_queries:
+            query = item["query"]
+            intent = item["intent"]
+
+            if intent == "greeting":
+                response = await generate_greeting_response(query, chat_history)
                 responses.append(response)
 
-    if responses:
-        # Add AI responses to history
-        for response in responses:
-            chat_history.add_ai_message(response)
-        
-        await update.message.reply_text("\n\n".join(responses))
+            elif intent in ["study_schedule", "set_reminder"]:
+                time_data = await extract_time_async(item, extract_time_llm)
+                if time_data:
+                    if time_data["type"] == "relative":
+                        asyncio.create_task(countdown_timer(context,update.effective_chat.id,time_data["seconds"]))
+                    elif time_data["type"] == "absolute":
+                        now = datetime.now()
+                        target = datetime.strptime(time_data["time"], "%I:%M %p").replace(
+                            year=now.year, month=now.month, day=now.day)
+                        if target < now:
+                            target += timedelta(days=1)
+                        delay = (target - now).total_seconds()
+                        asyncio.create_task(alarm_after(context, update.effective_chat.id, delay, time_data["time"]))
+                        responses.append(f"⏰ Alarm set for {time_data['time']}")
+                else:
+                    responses.append("⌛ Please give a valid time to schedule.")
+
+            elif intent == "motivation":
+                response = await generate_response(query, chat_history, intent)
+                responses.append(response)
+            else:
+                # Check if we have document context to use
+                context_text = await run_blocking(retrieve_relevant_text, query, 5, chat_id)
+                if context_text and "No relevant context" not in context_text:
+                    response = await generate_llama_response_with_context(query, context_text, chat_history)
+                    responses.append(response)
+                else:
+                    response = await generate_response(query, chat_history)
+                    responses.append(response)
+
+        if responses:
+            # Add AI responses to history
+            for response in responses:
+                chat_history.add_ai_message(response)
+            
+            await update.message.reply_text("\n\n".join(responses))
     
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -357,14 +356,20 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     voice: Voice = update.message.voice
+    set_requester(update.effective_chat.id)
     with tempfile.NamedTemporaryFile(delete=False, suffix=".ogg") as tmp:
         file = await context.bot.get_file(voice.file_id)
         await file.download_to_drive(tmp.name)
 
-    user_input = transcribe_audio_to_text(tmp.name)
+    user_input = await transcribe_audio_to_text(tmp.name)
     os.remove(tmp.name)
     await process_input(update, context, user_input)
 
+async def handle_error(update: object, context: ContextTypes.DEFAULT_TYPE):
+    print(f"Error handling update: {context.error}")
+    if isinstance(context.error, LLMUnavailable) and isinstance(update, Update) and update.message:
+        await update.message.reply_text("⏳ I'm a bit busy right now. Please try again in a moment.")
+
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Clear any existing history for this chat
     chat_id = str(update.effective_chat.id)
@@ -373,16 +378,44 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text("👋 Hey! I'm your AI Study Buddy. How can I help you today?")
 
+async def documents_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    documents = await run_blocking(retrieval.list_documents, str(update.effective_chat.id))
+    if not documents:
+        await update.message.reply_text("📂 No documents indexed yet.")
+        return
+    lines = [f"{i}. {doc['filename'] or doc['hash'][:12]} ({doc['chunks']} chunks)" for i, doc in enumerate(documents, 1)]
+    await update.message.reply_text("📂 Your documents:\n" + "\n".join(lines) + "\n\nUse /forget <number> or /forget all to remove them.")
+
+async def forget_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    namespace = str(update.effective_chat.id)
+    documents = await run_blocking(retrieval.list_documents, namespace)
+    arg = context.args[0].lower() if context.args else ""
+    if arg == "all":
+        selected = documents
+    elif arg.isdigit() and 1 <= int(arg) <= len(documents):
+        selected = [documents[int(arg) - 1]]
+    else:
+        await update.message.reply_text("⌛ Usage: /forget <number from /documents> or /forget all")
+        return
+    for doc in selected:
+        await run_blocking(retrieval.delete_document, doc["hash"], namespace)
+    await update.message.reply_text(f"🗑️ Removed {len(selected)} document(s).")
+
 def main():
+    retrieval.start_warm_up()  # loads the encoder while the bot connects
+    threading.Thread(target=intent_classifier.fit, daemon=True).start()
     telegram_token = os.getenv("TELEGRAM_BOT_TOKEN")
-    app = ApplicationBuilder().token(telegram_token).build()
+    app = ApplicationBuilder().token(telegram_token).concurrent_updates(BOT_CONCURRENT_UPDATES).build()
     
     # Add handlers
     app.add_handler(CommandHandler("start", start_command))
+    app.add_handler(CommandHandler("documents", documents_command))
+    app.add_handler(CommandHandler("forget", forget_command))
     app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handle_text))
     app.add_handler(MessageHandler(filters.VOICE, handle_voice))
     app.add_handler(MessageHandler(filters.PHOTO, handle_image))
     app.add_handler(MessageHandler(filters.Document.ALL, handle_document))
+    app.add_error_handler(handle_error)
 
     print("✅ Telegram bot running...")
     app.run_polling()